@@ -5,13 +5,38 @@ import requests
 from datetime import datetime
 from datetime import timedelta
 import pandas as pd
+from pandas.api.types import union_categoricals
 from io import StringIO
 from urllib.request import urlopen
 import xmltodict
 import numpy as np
 import warnings
-from sqlalchemy import create_engine
-import inspect
+from sqlalchemy import create_engine, text
+import functools
+from contextlib import contextmanager
+import argparse
+import json
+import signal
+import csv
+import uuid
+import threading
+import time
+import random
+import hashlib
+import cProfile
+import pstats
+import tracemalloc
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import timezone as dt_timezone
+from email.utils import parsedate_to_datetime
+import io
+
+try:
+    import pyarrow
+    import pyarrow.csv as pa_csv
+except ImportError:    # optional; ISU responses are parsed with the pandas C parser instead
+    pa_csv = None
 
 ########################
 # Utility functions    #
@@ -23,6 +48,149 @@ def timestamped_print(*args, **kwargs):
   old_print(datetime.now(), *args, **kwargs)
 print = timestamped_print
 
+# 2 or more prints full DataFrames for debugging
+VERBOSITY = int(os.environ.get("SDFP_VERBOSITY", 1))
+
+
+# Directory for `metrics.jsonl` and the `sdfp.prom` textfile. Empty (the default) disables the export
+METRICS_DIR = os.environ.get("SDFP_METRICS_DIR", "")
+# Size at which `metrics.jsonl` is rotated to `metrics.jsonl.1`, replacing the previous one
+METRICS_MAX_MB = float(os.environ.get("SDFP_METRICS_MAX_MB", 50))
+
+class RunMetrics:
+    """Stage timings and counters for one run, exported as JSON lines and a Prometheus textfile
+
+    Spans are recorded with the `timed` decorator or the `span` context manager; counters
+    (bytes downloaded, retries, 429s, ...) with `count`. Thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new run"""
+        with self.lock:
+            self.run_id = uuid.uuid4().hex
+            self.started = time.time()
+            self.spans = []
+            self.counters = {}
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Time a block. The yielded dict can be given a `rows` count"""
+        record = {"stage": stage, **labels}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            with self.lock:
+                self.spans.append(record)
+
+    def timed(self, stage, **labels):
+        """Decorator recording a span per call, with the row count of a returned DataFrame"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                print(func.__name__)    # print the name of the function we just entered
+                with self.span(stage, **labels) as record:
+                    result = func(*args, **kwargs)
+                    if isinstance(result, pd.DataFrame):
+                        record["rows"] = result.shape[0]
+                    return result
+            return wrapper
+        return decorator
+
+    def count(self, name, value = 1, **labels):
+        """Add `value` to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        """Per-(stage, labels) totals of seconds, rows and calls"""
+        totals = {}
+        with self.lock:
+            for record in self.spans:
+                labels = tuple(sorted((k, v) for k, v in record.items() if k not in ("stage", "seconds", "rows")))
+                total = totals.setdefault((record["stage"], labels), {"seconds": 0.0, "rows": 0, "calls": 0})
+                total["seconds"] += record["seconds"]
+                total["rows"] += record.get("rows", 0)
+                total["calls"] += 1
+        return totals
+
+    def export(self, directory = METRICS_DIR):
+        """Append this run's spans and counters to `metrics.jsonl` and rewrite `sdfp.prom` in `directory`
+
+        `metrics.jsonl` is rotated to `metrics.jsonl.1` once it reaches `METRICS_MAX_MB`.
+        """
+        if not directory:
+            return
+
+        os.makedirs(directory, exist_ok = True)
+        finished = time.time()
+        summary = self.summary()
+
+        with self.lock:
+            lines = [{"run_id": self.run_id, "type": "span", **record} for record in self.spans]
+            lines += [{"run_id": self.run_id, "type": "counter", "name": name, **dict(labels), "value": value}
+                      for (name, labels), value in self.counters.items()]
+            counters = dict(self.counters)
+        lines.append({"run_id": self.run_id, "type": "run", "started": self.started, "seconds": finished - self.started})
+
+        jsonl_path = os.path.join(directory, "metrics.jsonl")
+        if os.path.exists(jsonl_path) and os.path.getsize(jsonl_path) >= METRICS_MAX_MB * 1024 * 1024:
+            os.replace(jsonl_path, jsonl_path + ".1")
+        with open(jsonl_path, "a") as f:
+            for line in lines:
+                f.write(json.dumps(line, default = str) + "\n")
+
+        def prom_labels(labels):
+            def escape(v):
+                return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}" if labels else ""
+
+        # Each family's TYPE line comes right before its own samples
+        prom = []
+        for field, fmt in [("seconds", "{:.6f}"), ("rows", "{}"), ("calls", "{}")]:
+            prom.append(f"# TYPE sdfp_stage_{field} gauge")
+            for (stage, labels), total in sorted(summary.items()):
+                prom.append(f"sdfp_stage_{field}{prom_labels((('stage', stage),) + labels)} {fmt.format(total[field])}")
+        for name in sorted({name for name, labels in counters}):
+            prom.append(f"# TYPE sdfp_{name} gauge")
+            for labels, value in sorted((labels, value) for (n, labels), value in counters.items() if n == name):
+                prom.append(f"sdfp_{name}{prom_labels(labels)} {value}")
+        prom.append("# TYPE sdfp_run_seconds gauge")
+        prom.append(f"sdfp_run_seconds {finished - self.started:.6f}")
+        prom.append("# TYPE sdfp_last_run_timestamp_seconds gauge")
+        prom.append(f"sdfp_last_run_timestamp_seconds {finished:.0f}")
+
+        # Write then rename, so the textfile collector never reads a partial file
+        prom_path = os.path.join(directory, "sdfp.prom")
+        with open(prom_path + f".{os.getpid()}.tmp", "w") as f:
+            f.write("\n".join(prom) + "\n")
+        os.replace(prom_path + f".{os.getpid()}.tmp", prom_path)
+
+
+metrics = RunMetrics()
+timed = metrics.timed
+
+
+def exports_metrics(func):
+    """Reset `metrics` before a run and export them after it, however it ends"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        metrics.reset()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            try:
+                metrics.export()
+            except Exception as ex:
+                print(f"metrics export error: {type(ex).__name__}: {ex}")
+    return wrapper
+
 
 def slicer(my_str,sub):
         index=my_str.find(sub)
@@ -32,6 +200,192 @@ def slicer(my_str,sub):
             raise Exception('Sub string not found!')
         
         
+class TokenBucket:
+    """Thread-safe token bucket. Each request takes one token; tokens refill at `rate` per second up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def defer(self, seconds):
+        """Hand out no tokens for `seconds` (e.g. a 429 `Retry-After`) and drain the ones already banked"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class ProviderLimiter:
+    """Concurrency cap plus token-bucket rate limit for a single atmospheric pressure provider"""
+
+    def __init__(self, max_concurrent, rate, burst):
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.bucket = TokenBucket(rate = rate, capacity = burst)
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        self.bucket.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.semaphore.release()
+        return False
+
+
+# Provider endpoints, overridable to point at a local stand-in (see benchmark.py)
+NOAA_URL = os.environ.get("SDFP_NOAA_URL", "https://api.tidesandcurrents.noaa.gov/api/prod/datagetter/")
+NWS_URL = os.environ.get("SDFP_NWS_URL", "https://api.weather.gov")
+ISU_URL = os.environ.get("SDFP_ISU_URL", "https://mesonet.agron.iastate.edu/cgi-bin/request/asos.py")
+
+# Per-provider limits: max requests in flight, sustained requests/second, and burst size
+PROVIDER_LIMITS = {
+    "NOAA": {"max_concurrent": 4, "rate": 2.0, "burst": 4},
+    "NWS": {"max_concurrent": 2, "rate": 1.0, "burst": 2},
+    "ISU": {"max_concurrent": 2, "rate": 0.5, "burst": 2},
+    "FIMAN": {"max_concurrent": 4, "rate": 10.0, "burst": 10},
+}
+
+ATM_FETCH_WORKERS = int(os.environ.get("ATM_FETCH_WORKERS", 8))
+
+provider_limiters = {name: ProviderLimiter(**limits) for name, limits in PROVIDER_LIMITS.items()}
+
+USER_AGENT = "Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project"
+
+# Attempts per provider request, and the cap (seconds) on the exponential backoff between them
+PROVIDER_RETRIES = int(os.environ.get("SDFP_PROVIDER_RETRIES", 3))
+PROVIDER_MAX_BACKOFF = float(os.environ.get("SDFP_PROVIDER_MAX_BACKOFF", 30))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def provider_session(provider):
+    """A pooled `requests.Session` for a provider
+
+    The pool holds one keep-alive connection per concurrent request the provider allows, so
+    each host costs one TLS handshake per connection for the life of the process (and between
+    cycles in `--serve` mode), and responses are requested gzip-compressed.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = PROVIDER_LIMITS[provider]["max_concurrent"])
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "User-Agent": USER_AGENT})
+    return session
+
+provider_sessions = {name: provider_session(name) for name in PROVIDER_LIMITS}
+
+
+def retry_after_seconds(r, default):
+    """Seconds to wait from a response's `Retry-After` header, which may be a number or an HTTP date"""
+    value = r.headers.get('Retry-After')
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        try:
+            return max(0, (parsedate_to_datetime(value) - datetime.now(tz=dt_timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return default
+
+
+def backoff_delay(attempt, base = 1.0, cap = PROVIDER_MAX_BACKOFF):
+    """Exponential backoff with full jitter: uniform in [0, min(cap, base * 2 ** attempt)]"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def provider_get(provider, url, **kwargs):
+    """`requests.get` on the provider's pooled session, with its rate limit and retries
+
+    The request counts against the provider's concurrency cap and token bucket. Connection
+    errors, timeouts, 429s and 5xx responses are retried up to `PROVIDER_RETRIES` times with
+    jittered exponential backoff. A 429 also pauses the provider's token bucket for
+    `Retry-After` seconds, so every thread waits it out, not just the one that got rate limited.
+
+    Args:
+        provider (str): Key into `PROVIDER_LIMITS`
+        url (str): URL to request
+        **kwargs: Passed on to `requests.Session.get`
+
+    Returns:
+        requests.Response: The last response, which may still be an error status. Pass
+            `stream=True` to read the body incrementally from `r.raw`
+
+    Raises:
+        requests.exceptions.RequestException: If the last attempt failed to get a response
+    """
+    limiter = provider_limiters[provider]
+    session = provider_sessions[provider]
+
+    for attempt in range(PROVIDER_RETRIES):
+        if attempt > 0:
+            metrics.count("http_retries_total", provider = provider)
+            time.sleep(backoff_delay(attempt - 1))
+
+        try:
+            with limiter:
+                r = session.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.count("http_errors_total", provider = provider, error = type(e).__name__)
+            print(f"{provider} request failed (attempt {attempt + 1}/{PROVIDER_RETRIES}): {type(e).__name__}: {e}")
+            if attempt == PROVIDER_RETRIES - 1:
+                raise
+            continue
+
+        metrics.count("http_requests_total", provider = provider, status = r.status_code)
+        if capture is not None:
+            capture.save_response(provider, url, kwargs.get("params"), r, attempt, stream = kwargs.get("stream", False))
+        # Bytes on the wire; `r.content` is already decompressed, and would consume a streamed body
+        if "Content-Length" in r.headers:
+            metrics.count("http_bytes_total", int(r.headers["Content-Length"]), provider = provider)
+        elif not kwargs.get("stream"):
+            metrics.count("http_bytes_total", len(r.content), provider = provider)
+
+        if r.status_code == 429:
+            metrics.count("http_429_total", provider = provider)
+            limiter.bucket.defer(retry_after_seconds(r, default = 1))
+
+        if r.status_code not in RETRY_STATUSES or attempt == PROVIDER_RETRIES - 1:
+            return r
+        r.close()
+        print(f"{provider} returned {r.status_code} (attempt {attempt + 1}/{PROVIDER_RETRIES})")
+    
+    
+def database_url():
+    """Connection URL built from the `POSTGRESQL_*` environment variables"""
+    return "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+
+engine_lock = threading.Lock()
+shared_engine = None
+
+def get_engine():
+    """The pooled engine shared by everything in this process, created on first use"""
+    global shared_engine
+    with engine_lock:
+        if shared_engine is None:
+            shared_engine = create_engine(database_url(), pool_size = 5, max_overflow = 5, pool_pre_ping = True)
+        return shared_engine
+        
+        
 def postgres_upsert(table, conn, keys, data_iter):
     from sqlalchemy.dialects.postgresql import insert
 
@@ -57,10 +411,128 @@ def postgres_safe_insert(table, conn, keys, data_iter):
     conn.execute(upsert_statement)
     
 
+# `SDFP_WRITE_METHOD` is one of `WRITE_METHODS`; `SDFP_WRITE_CHUNKSIZE` is the number of rows per batch
+WRITE_METHOD = os.environ.get("SDFP_WRITE_METHOD", "upsert")
+WRITE_CHUNKSIZE = int(os.environ.get("SDFP_WRITE_CHUNKSIZE", 10000))
+
+
+def quote_ident(name):
+    """Quote a Postgres identifier (needed for mixed-case columns such as `sensor_ID`)"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def copy_to_staging(cursor, target, columns, rows):
+    """Stream rows with `COPY FROM STDIN` into a temporary table with `columns` of `target`
+
+    Args:
+        cursor: psycopg2 cursor
+        target (str): Quoted name of the table the staging table copies its column types from
+        columns (list): Column names, in the order of the values in `rows`
+        rows (iterable): Rows of values. None and NaN are written as NULL
+
+    Returns:
+        str: Name of the staging table. It is dropped at the end of the transaction
+    """
+    staging = "staging_" + uuid.uuid4().hex
+    column_list = ", ".join(quote_ident(c) for c in columns)
+
+    # Only the column types are copied, so constraints on columns that are not staged don't apply
+    cursor.execute(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {column_list} FROM {target} WITH NO DATA")
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([r"\N" if v is None or v != v else v for v in row])    # (v != v is True only for NaN/NaT)
+    buffer.seek(0)
+
+    cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+
+    return staging
+
+
+def postgres_copy_upsert(table, conn, keys, data_iter):
+    """Upsert through `COPY FROM STDIN` into a staging table and one set-based `INSERT ... SELECT ... ON CONFLICT`
+
+    Same result as `postgres_upsert`, without building a dict and a bound parameter per value.
+    Use it as the `method` of `DataFrame.to_sql`; `chunksize` sets the batch size.
+    """
+    target = quote_ident(table.table.name) if table.schema is None else quote_ident(table.schema) + "." + quote_ident(table.table.name)
+    column_list = ", ".join(quote_ident(k) for k in keys)
+    update_list = ", ".join(f"{quote_ident(k)} = EXCLUDED.{quote_ident(k)}" for k in keys)
+
+    cursor = conn.connection.cursor()
+    try:
+        staging = copy_to_staging(cursor, target, keys, data_iter)
+        cursor.execute(f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {staging} "
+                       f"ON CONFLICT ON CONSTRAINT {quote_ident(table.table.name + '_pkey')} DO UPDATE SET {update_list}")
+        cursor.execute(f"DROP TABLE {staging}")
+    finally:
+        cursor.close()
+
+
+@timed("write", table = "sensor_data", method = "mark_processed")
+def mark_sensor_data_processed(conn, keys, chunksize = WRITE_CHUNKSIZE):
+    """Set the `processed` flag of `sensor_data` rows, sending only their keys
+
+    Each chunk is copied into a staging table and applied with one `UPDATE ... FROM`, so
+    the wide raw rows are neither sent back nor rewritten unless the flag changes.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): Connection inside the transaction that wrote `sensor_water_depth`
+        keys (pd.DataFrame): Columns `place`, `sensor_ID`, `date` and `processed`
+        chunksize (int): Rows per chunk
+
+    Returns:
+        int: Number of rows updated
+    """
+    columns = ["place", "sensor_ID", "date", "processed"]
+    keys = keys.loc[:, columns].drop_duplicates(subset = columns[:3])
+
+    updated = 0
+    cursor = conn.connection.cursor()
+    try:
+        for start in range(0, keys.shape[0], chunksize):
+            chunk = keys.iloc[start:start + chunksize]
+            staging = copy_to_staging(cursor, "sensor_data", columns, chunk.itertuples(index = False, name = None))
+            cursor.execute(f"""UPDATE sensor_data AS d SET processed = s.processed FROM {staging} AS s
+                               WHERE d.place = s.place AND d."sensor_ID" = s."sensor_ID" AND d.date = s.date
+                               AND d.processed IS DISTINCT FROM s.processed""")
+            updated += cursor.rowcount
+            cursor.execute(f"DROP TABLE {staging}")
+    finally:
+        cursor.close()
+
+    return updated
+
+
+WRITE_METHODS = {"upsert": postgres_upsert, "safe_insert": postgres_safe_insert, "copy": postgres_copy_upsert}
+
+def write_table(df, name, con, method = WRITE_METHOD, chunksize = WRITE_CHUNKSIZE):
+    """Write a DataFrame (keyed by its index) to a table with one of the `WRITE_METHODS` and report the throughput
+
+    `to_sql` converts every value of the frame it's given to a Python object before writing any
+    of it, so it is given one batch of rows at a time.
+
+    Args:
+        df (pd.DataFrame): Data to write. The index holds the primary key columns
+        name (str): Table name
+        con (sqlalchemy.engine.Engine or Connection): Where to write
+        method (str): Key into `WRITE_METHODS`
+        chunksize (int): Rows per batch
+    """
+    with metrics.span("write", table = name, method = method) as record:
+        record["rows"] = df.shape[0]
+        for start in range(0, df.shape[0], chunksize):
+            df.iloc[start:start + chunksize].to_sql(name, con, if_exists = "append", method = WRITE_METHODS[method])
+    elapsed = record["seconds"]
+    print(f"Wrote {df.shape[0]} rows to `{name}` with {method} in {elapsed:.2f} s ({df.shape[0] / max(elapsed, 1e-9):.0f} rows/s)")
+    
+
 #############################
 # Method-specific functions #
 #############################
 
+@timed("fetch", provider = "NOAA")
 def get_noaa_atm(id, begin_date, end_date):
     """Retrieve atmospheric pressure data from the NOAA tides and currents API
 
@@ -72,135 +544,180 @@ def get_noaa_atm(id, begin_date, end_date):
     Returns:
         r_df (pd.DataFrame): DataFrame of atmospheric pressure from specified station and time range. Dates in UTC
     """    
-    import time
-    
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
     print(f"get_noaa_atm request: id={id}, begin_date={begin_date}, end_date={end_date}")
     
-    max_retries = 2
-    retry_delay = 1
-    
-    for attempt in range(max_retries):
-        try:
-            query = {'station' : str(id),
-                     'begin_date' : begin_date,
-                     'end_date' : end_date,
-                     'product' : 'air_pressure',
-                     'units' : 'metric',
-                     'time_zone' : 'gmt',
-                     'format' : 'json',
-                     'application' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'}
-            
-            if attempt > 0:
-                print(f"get_noaa_atm retry attempt {attempt + 1}/{max_retries}")
-                time.sleep(retry_delay)
-            
-            r = requests.get('https://api.tidesandcurrents.noaa.gov/api/prod/datagetter/', params=query, timeout=10)
-            
-            if r.status_code == 429:
-                if attempt < max_retries - 1:
-                    retry_after = int(r.headers.get('Retry-After', retry_delay))
-                    print(f"get_noaa_atm rate limited (429). Waiting {retry_after} seconds before retry...")
-                    time.sleep(retry_after)
-                    retry_delay = retry_after * 2
-                    continue
-            
-            print("get_noaa_atm status:", r.status_code)
-            if r.status_code != 200:
-                print("get_noaa_atm unexpected response:", repr(r.text[:500]))
-                return pd.DataFrame()
-            
-            j = r.json()
-
-            if ('data' not in j):
-                return pd.DataFrame()
-
-            r_df = pd.DataFrame.from_dict(j["data"])
-            
-            r_df['v'].replace('', np.nan, inplace=True)
-            r_df["t"] = pd.to_datetime(r_df["t"], utc=True) 
-            r_df["id"] = str(id) 
-            r_df["notes"] = "coop"
-            r_df = r_df.loc[:,["id","t","v","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
-
-            return r_df.dropna()
-        except requests.exceptions.RequestException as e:
-            print(f"get_noaa_atm request failed: {type(e).__name__}: {e}")
+    try:
+        query = {'station' : str(id),
+                 'begin_date' : begin_date,
+                 'end_date' : end_date,
+                 'product' : 'air_pressure',
+                 'units' : 'metric',
+                 'time_zone' : 'gmt',
+                 'format' : 'json',
+                 'application' : USER_AGENT}
+        
+        r = provider_get("NOAA", NOAA_URL, params=query, timeout=10)
+        
+        print("get_noaa_atm status:", r.status_code)
+        if r.status_code != 200:
+            print("get_noaa_atm unexpected response:", repr(r.text[:500]))
             return pd.DataFrame()
-        except Exception as e:
-            print(f"get_noaa_atm error: {type(e).__name__}: {e}")
+        
+        j = r.json()
+
+        if ('data' not in j):
             return pd.DataFrame()
+
+        r_df = pd.DataFrame.from_dict(j["data"])
+        
+        r_df['v'].replace('', np.nan, inplace=True)
+        r_df["t"] = pd.to_datetime(r_df["t"], utc=True) 
+        r_df["id"] = str(id) 
+        r_df["notes"] = "coop"
+        r_df = r_df.loc[:,["id","t","v","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
+
+        return r_df.dropna()
+    except requests.exceptions.RequestException as e:
+        print(f"get_noaa_atm request failed: {type(e).__name__}: {e}")
+        return pd.DataFrame()
+    except Exception as e:
+        print(f"get_noaa_atm error: {type(e).__name__}: {e}")
+        return pd.DataFrame()
     
-    return pd.DataFrame()
-    
+# Observations per NWS page (the API allows up to 500), and a guard against pagination that never ends
+NWS_PAGE_SIZE = 500
+NWS_MAX_PAGES = 100
+
+@timed("fetch", provider = "NWS")
 def get_nws_atm(id, begin_date, end_date):
     """Retrieve atmospheric pressure data from the NWS API
 
+    Observations come back newest first, a page at a time, and `pagination.next` is followed
+    until a page comes back with fewer than `NWS_PAGE_SIZE` features, or without a next link, so
+    the last page isn't followed by a request for an empty one. Only the timestamp and barometric pressure (Pa) of each
+    feature are read. A page that fails discards the whole request, so a partial result is
+    never stored as covering the window.
+
     Args:
         id (str): Station id
         begin_date (str): Beginning date of requested time period. Format: %Y%m%d %H:%M
         end_date (str): End date of requested time period. Format: %Y%m%d %H:%M
         
     Returns:
-        response (str): Still working on this!        
+        r_df (pd.DataFrame): DataFrame of atmospheric pressure from specified station and time range. Dates in UTC
     """    
-    import time
-    
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
     print(f"get_nws_atm request: id={id}, begin_date={begin_date}, end_date={end_date}")
     
-    max_retries = 2
-    retry_delay = 1
-    
-    for attempt in range(max_retries):
-        try:
-            new_begin_date = pd.to_datetime(begin_date, utc=True) - timedelta(seconds = 3600)
-            new_end_date = pd.to_datetime(end_date, utc=True) + timedelta(seconds = 3600)
+    try:
+        new_begin_date = pd.to_datetime(begin_date, utc=True) - timedelta(seconds = 3600)
+        new_end_date = pd.to_datetime(end_date, utc=True) + timedelta(seconds = 3600)
 
-            query = {'start' : new_begin_date.isoformat(),
-                     'end' : new_end_date.isoformat()}
-            
-            url = "https://api.weather.gov/stations/" + str(id) + "/observations"
-            if attempt > 0:
-                print(f"get_nws_atm retry attempt {attempt + 1}/{max_retries}")
-                time.sleep(retry_delay)
-            
-            print("get_nws_atm url:", url)
-            print("get_nws_atm params:", query)
-            r = requests.get(url, params=query, headers = {'accept': 'application/geo+json'}, timeout=10)
-            
-            if r.status_code == 429:
-                if attempt < max_retries - 1:
-                    retry_after = int(r.headers.get('Retry-After', retry_delay))
-                    print(f"get_nws_atm rate limited (429). Waiting {retry_after} seconds before retry...")
-                    time.sleep(retry_after)
-                    retry_delay = retry_after * 2
-                    continue
+        url = NWS_URL + "/stations/" + str(id) + "/observations"
+        query = {'start' : new_begin_date.isoformat(),
+                 'end' : new_end_date.isoformat(),
+                 'limit' : NWS_PAGE_SIZE}
+        print("get_nws_atm url:", url)
+        print("get_nws_atm params:", query)
+        
+        times, values = [], []
+        for page in range(NWS_MAX_PAGES):
+            r = provider_get("NWS", url, params=query, headers = {'accept': 'application/geo+json'}, timeout=10)
             
-            print("get_nws_atm status:", r.status_code)
             if r.status_code != 200:
+                print("get_nws_atm status:", r.status_code)
                 print("get_nws_atm unexpected response:", repr(r.text[:500]))
                 return pd.DataFrame()
 
             j = r.json()
-            print("get_nws_atm response keys:", list(j.keys()))
-            
-            # r_df = pd.DataFrame.from_dict(j["data"])
-            
-            # r_df["t"] = pd.to_datetime(r_df["t"], utc=True); r_df["id"] = id; r_df["notes"] = "coop"
+            features = j.get("features", [])
+            for feature in features:
+                properties = feature["properties"]
+                times.append(properties["timestamp"])
+                values.append((properties.get("barometricPressure") or {}).get("value"))
             
-            # r_df = r_df.loc[:,["id","t","v","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
-            
-            return pd.DataFrame()
-        except requests.exceptions.RequestException as e:
-            print(f"get_nws_atm request failed: {type(e).__name__}: {e}")
-            return pd.DataFrame()
-        except Exception as e:
-            print(f"get_nws_atm error: {type(e).__name__}: {e}")
-            return pd.DataFrame()
-    
-    return pd.DataFrame()
+            next_url = (j.get("pagination") or {}).get("next")
+            if len(features) < NWS_PAGE_SIZE or not next_url or next_url == url:
+                break
+            # The next link carries the whole query
+            url, query = next_url, None
+        else:
+            warnings.warn(f"get_nws_atm stopped after {NWS_MAX_PAGES} pages for station {id}")
+        
+        print(f"get_nws_atm parsed {len(times)} observations from {page + 1} page(s)")
+        
+        r_df = pd.DataFrame({"id": str(id),
+                             "date": pd.to_datetime(times, utc=True),
+                             "pressure_mb": np.array(values, dtype=float) / 100,
+                             "notes": "NWS"})
+        
+        return r_df.dropna().sort_values("date").reset_index(drop=True)
+    except requests.exceptions.RequestException as e:
+        print(f"get_nws_atm request failed: {type(e).__name__}: {e}")
+        return pd.DataFrame()
+    except Exception as e:
+        print(f"get_nws_atm error: {type(e).__name__}: {e}")
+        return pd.DataFrame()
+
+INHG_TO_MB = 1000 * 0.0338639
+ISU_NA_VALUES = ["", "NA", "M"]
+# ASOS stations report hourly, so ISU windows are widened to take in the observations on either side
+ISU_PADDING = timedelta(hours = 2)
+
+
+def skip_to_header(stream, marker = b"station"):
+    """Consume a binary stream up to and including its CSV header line
+
+    Args:
+        stream (io.BufferedReader): Response body
+        marker (bytes): Start of the header line
+
+    Returns:
+        list: Column names, or None if the stream ended first
+    """
+    for line in stream:
+        if line.startswith(marker):
+            return line.decode().strip().split(",")
+    return None
+
+
+def parse_isu_csv(stream):
+    """Parse an ISU ASOS CSV response body as it streams in
 
+    The preamble is skipped line by line, and only `valid` and `alti` are parsed, with explicit
+    types, by pyarrow when it is installed and the pandas C parser otherwise.
+
+    Args:
+        stream (io.BufferedReader): Response body
+
+    Returns:
+        pd.DataFrame: `date` (UTC) and `pressure_mb` columns, or None if there was no header
+    """
+    columns = skip_to_header(stream)
+    if columns is None:
+        return None
+
+    if not stream.peek(1):
+        r_df = pd.DataFrame({"valid": pd.Series(dtype = "datetime64[ns]"), "alti": pd.Series(dtype = "float64")})
+    elif pa_csv is not None:
+        table = pa_csv.read_csv(stream,
+                                read_options = pa_csv.ReadOptions(column_names = columns),
+                                convert_options = pa_csv.ConvertOptions(
+                                    include_columns = ["valid", "alti"],
+                                    column_types = {"valid": pyarrow.timestamp("s"), "alti": pyarrow.float64()},
+                                    null_values = ISU_NA_VALUES,
+                                    timestamp_parsers = ["%Y-%m-%d %H:%M"]))
+        r_df = table.to_pandas()
+    else:
+        r_df = pd.read_csv(stream, header = None, names = columns, usecols = ["valid", "alti"],
+                           dtype = {"valid": str, "alti": "float64"}, na_values = ISU_NA_VALUES)
+        r_df["valid"] = pd.to_datetime(r_df["valid"], format = "%Y-%m-%d %H:%M")
+
+    r_df.rename(columns = {"valid": "date", "alti": "pressure_mb"}, inplace = True)
+    r_df["date"] = r_df["date"].dt.tz_localize("UTC")
+    r_df["pressure_mb"] *= INHG_TO_MB
+    return r_df
+
+@timed("fetch", provider = "ISU")
 def get_isu_atm(id, begin_date, end_date):
     """Retrieve atmospheric pressure data from the ISU ASOS download service
 
@@ -209,88 +726,113 @@ def get_isu_atm(id, begin_date, end_date):
         begin_date (str): Beginning date of requested time period. Format: %Y%m%d %H:%M
         end_date (str): End date of requested time period. Format: %Y%m%d %H:%M
     """   
-    import time
-    
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
     print(f"get_isu_atm request: id={id}, begin_date={begin_date}, end_date={end_date}")
     
-    max_retries = 3
-    retry_delay = 1  # start with 1 second
-    
-    for attempt in range(max_retries):
-        try:
-            new_begin_date = pd.to_datetime(begin_date, utc=True) 
-            new_end_date = pd.to_datetime(end_date, utc=True) + timedelta(days=1)
-            query = {'station' : str(id),
-                     'data' : 'all',
-                     'year1' : new_begin_date.year,
-                     'month1' : new_begin_date.month,
-                     'day1' : new_begin_date.day,
-                     'year2' : new_end_date.year,
-                     'month2' : new_end_date.month,
-                     'day2' : new_end_date.day,
-                     'product' : 'air_pressure',
-                     'format' : 'comma',
-                     'latlon' : 'yes',
-                     'tz' : 'Etc/UTC'
-                     }
-            if attempt > 0:
-                print(f"get_isu_atm retry attempt {attempt + 1}/{max_retries}, query: {query}")
-            else:
-                print("get_isu_atm query:", query)
-            
-            r = requests.get(url = 'https://mesonet.agron.iastate.edu/cgi-bin/request/asos.py', params=query, headers={'User-Agent' : 'Sunny_Day_Flooding_project, https://github.com/sunny-day-flooding-project'}, timeout=10)
-            
-            # Handle rate limiting with retry
+    try:
+        # Request to the minute so that incremental tail fetches don't pull whole days, padded by
+        # ISU_PADDING to take in the hourly observations around the window, and only the altimeter
+        # setting, the one field we use
+        new_begin_date, new_end_date = _atm_request_bounds("ISU", begin_date, end_date)
+        query = {'station' : str(id),
+                 'data' : 'alti',
+                 'year1' : new_begin_date.year,
+                 'month1' : new_begin_date.month,
+                 'day1' : new_begin_date.day,
+                 'hour1' : new_begin_date.hour,
+                 'minute1' : new_begin_date.minute,
+                 'year2' : new_end_date.year,
+                 'month2' : new_end_date.month,
+                 'day2' : new_end_date.day,
+                 'hour2' : new_end_date.hour,
+                 'minute2' : new_end_date.minute,
+                 'format' : 'comma',
+                 'latlon' : 'no',
+                 'tz' : 'Etc/UTC'
+                 }
+        print("get_isu_atm query:", query)
+        
+        r = provider_get("ISU", url = ISU_URL, params=query, timeout=10, stream=True)
+        
+        with r:
             if r.status_code == 429:
-                if attempt < max_retries - 1:
-                    retry_after = int(r.headers.get('Retry-After', retry_delay))
-                    print(f"get_isu_atm rate limited (429). Waiting {retry_after} seconds before retry...")
-                    time.sleep(retry_after)
-                    retry_delay = retry_after * 2  # exponential backoff
-                    continue
-                else:
-                    print(f"get_isu_atm rate limited (429) and max retries exceeded.")
-                    return pd.DataFrame()
+                print(f"get_isu_atm rate limited (429) and max retries exceeded.")
+                return pd.DataFrame()
             
             r.raise_for_status()
             print("get_isu_atm status:", r.status_code)
             
-            text = r.text
-            if not text or len(text.strip()) == 0:
-                print("get_isu_atm: API returned empty response body.")
-                return pd.DataFrame()
-            
-            if "station" not in text:
-                print("get_isu_atm: unexpected API response; expected CSV header containing 'station'.")
-                print("status_code:", r.status_code)
-                print("response length:", len(text), "bytes")
-                print("response snippet:", repr(text[:500]))
-                return pd.DataFrame()
-            
-            s = text[text.find("station"):] 
-            data = StringIO(s)
-            r_df = pd.read_csv(filepath_or_buffer=data, lineterminator="\n", na_values=["","NA","M"])
-            print(f"get_isu_atm parsed {r_df.shape[0]} rows from CSV")
-            
-            r_df["date"] = pd.to_datetime(r_df["valid"], utc=True); r_df["id"] = str(id); r_df["notes"] = "ISU"; r_df["pressure_mb"] = r_df["alti"] * 1000 * 0.0338639
-            r_df = r_df.loc[:,["id","date","pressure_mb","notes"]].rename(columns = {"id":"id","t":"date","v":"pressure_mb"})
-            return r_df
-            
-        except requests.exceptions.HTTPError as e:
-            print(f"get_isu_atm HTTP error: {e.response.status_code} {e.response.reason}")
-            return pd.DataFrame()
-        except requests.exceptions.RequestException as e:
-            print(f"get_isu_atm request failed: {type(e).__name__}: {e}")
-            return pd.DataFrame()
-        except Exception as e:
-            print(f"get_isu_atm error: {type(e).__name__}: {e}")
+            # Keep the raw stream open once drained, so the buffered reader can finish reading it
+            r.raw.decode_content = True
+            r.raw.auto_close = False
+            stream = io.BufferedReader(r.raw)
+            r_df = parse_isu_csv(stream)
+        
+        if r_df is None:
+            print("get_isu_atm: unexpected API response; expected CSV header containing 'station'.")
             return pd.DataFrame()
-    
-    return pd.DataFrame()
+        print(f"get_isu_atm parsed {r_df.shape[0]} rows from CSV")
+        
+        r_df["id"] = str(id); r_df["notes"] = "ISU"
+        return r_df.loc[:,["id","date","pressure_mb","notes"]]
+        
+    except requests.exceptions.HTTPError as e:
+        print(f"get_isu_atm HTTP error: {e.response.status_code} {e.response.reason}")
+        return pd.DataFrame()
+    except requests.exceptions.RequestException as e:
+        print(f"get_isu_atm request failed: {type(e).__name__}: {e}")
+        return pd.DataFrame()
+    except Exception as e:
+        print(f"get_isu_atm error: {type(e).__name__}: {e}")
+        return pd.DataFrame()
+
+@timed("fetch", provider = "FIMAN")
+def get_fiman_atm_batch(windows):
+    """Retrieve FIMAN atmospheric pressure for several stations from `api_data` with one query
+
+    Args:
+        windows (dict): {station id: (begin_date, end_date)}. Dates format: %Y%m%d %H:%M
+        
+    Returns:
+        dict: {station id: pd.DataFrame} of atmospheric pressure for each station's window. Dates in UTC
+    """
+    print(f"get_fiman_atm_batch request: {windows}")
+
+    bounds = {str(id): (pd.to_datetime(begin_date, utc=True) - timedelta(seconds = 3600), pd.to_datetime(end_date, utc=True) + timedelta(seconds = 3600))
+              for id, (begin_date, end_date) in windows.items()}
+
+    try:
+        query = text("SELECT id, date, value FROM api_data "
+                     "WHERE id = ANY(:ids) AND api_name = 'FIMAN' AND type = 'pressure' AND date >= :begin AND date <= :end")
+        params = {"ids": list(bounds.keys()),
+                  "begin": min(b for b, e in bounds.values()).to_pydatetime(),
+                  "end": max(e for b, e in bounds.values()).to_pydatetime()}
+        print("get_fiman_atm_batch SQL query:", query, params)
+        with provider_limiters["FIMAN"]:
+            r_df = pd.read_sql_query(query, get_engine(), params = params)
+    except Exception as e:
+        print(f"get_fiman_atm_batch error: {type(e).__name__}: {e}")
+        return {id: pd.DataFrame() for id in bounds}
+
+    r_df["date"] = pd.to_datetime(r_df["date"], utc = True)
+    # Ids are matched as strings, whatever type the driver returned them as
+    r_df["id"] = r_df["id"].astype(str)
+    r_df = r_df.rename(columns = {"value":"pressure_mb"}).assign(notes = "FIMAN")
+
+    results = {}
+    for id, station_data in r_df.groupby("id", sort = False):
+        window = bounds.get(id)
+        if window is None:
+            warnings.warn(f"get_fiman_atm_batch: `api_data` returned station {id!r}, which wasn't requested; skipping it")
+            continue
+        begin, end = window
+        station_data = station_data.loc[(station_data["date"] >= begin) & (station_data["date"] <= end)]
+        results[id] = station_data.sort_values(['date']).drop_duplicates().loc[:,["id","date","pressure_mb","notes"]]
+
+    return {id: results.get(id, pd.DataFrame()) for id in bounds}
+
 
 def get_fiman_atm(id, begin_date, end_date):
-    """Retrieve atmospheric pressure data from the NOAA tides and currents API
+    """Retrieve atmospheric pressure data for one FIMAN station from the `api_data` table
 
     Args:
         id (str): Station id
@@ -300,113 +842,993 @@ def get_fiman_atm(id, begin_date, end_date):
     Returns:
         r_df (pd.DataFrame): DataFrame of atmospheric pressure from specified station and time range. Dates in UTC
     """    
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
-    print(f"get_fiman_atm request: id={id}, begin_date={begin_date}, end_date={end_date}")
+    return get_fiman_atm_batch({str(id): (begin_date, end_date)})[str(id)]
 
-    try:
-        new_begin_date = pd.to_datetime(begin_date, utc=True) - timedelta(seconds = 3600)
-        new_end_date = pd.to_datetime(end_date, utc=True) + timedelta(seconds = 3600)
+###########################
+# atm pressure store      #
+###########################
 
-        SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
-            'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+ATM_STORE_DDL = [
+    """CREATE TABLE IF NOT EXISTS atm_pressure_cache (
+        src text NOT NULL,
+        station_id text NOT NULL,
+        date timestamptz NOT NULL,
+        pressure_mb double precision,
+        notes text,
+        PRIMARY KEY (src, station_id, date)
+    )""",
+    """CREATE TABLE IF NOT EXISTS atm_pressure_cache_coverage (
+        src text NOT NULL,
+        station_id text NOT NULL,
+        begin_date timestamptz NOT NULL,
+        end_date timestamptz NOT NULL,
+        PRIMARY KEY (src, station_id, begin_date)
+    )""",
+]
 
-        engine = create_engine(SQLALCHEMY_DATABASE_URL)
-        query = "SELECT * FROM api_data WHERE id='" + id + "' AND api_name='FIMAN' AND type='pressure' AND date >= '" + new_begin_date.strftime('%Y-%m-%d %H:%M:%S') + "' AND date <= '" + new_end_date.strftime('%Y-%m-%d %H:%M:%S') + "'"
-        print("get_fiman_atm SQL query:", query)
-        r_df = pd.read_sql_query(query, engine).sort_values(['date']).drop_duplicates()
-        r_df["date"] = pd.to_datetime(r_df["date"], utc = True); 
-        r_df = r_df.loc[:,["id","date","value","api_name"]].rename(columns = {"value":"pressure_mb", "api_name":"notes"})
-        engine.dispose()
 
-        return r_df
-    except Exception as e:
-        print(f"get_fiman_atm error: {type(e).__name__}: {e}")
-        return pd.DataFrame()
+def merge_intervals(intervals):
+    """Merge overlapping or touching (begin, end) intervals
 
-#####################
-# atm API functions #
-#####################
+    Args:
+        intervals (list): List of (begin, end) tuples
 
-def get_atm_pressure(atm_id, atm_src, begin_date, end_date):
-    """Yo, yo, yo, it's a wrapper function!
+    Returns:
+        list: Sorted, non-overlapping list of (begin, end) tuples
+    """
+    merged = []
+    for begin, end in sorted(intervals):
+        if merged and begin <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def missing_intervals(coverage, begin, end):
+    """Parts of [begin, end] that are not inside any of the covered intervals
 
     Args:
-        atm_id (str): Value from `sensor_surveys` table that declares the ID of the station to use for atmospheric pressure data.
-        atm_src (str): Value from `sensor_surveys` table that declares the source of the atmospheric pressure data.
-        begin_date (str): The beginning date to retrieve data. Format: %Y%m%d %H:%M
-        end_date (str): The end date to retrieve data. Format: %Y%m%d %H:%M
+        coverage (list): Sorted, non-overlapping list of (begin, end) tuples, as returned by `merge_intervals`
+        begin (pd.Timestamp): Beginning of the requested range
+        end (pd.Timestamp): End of the requested range
 
     Returns:
-        pandas.DataFrame: Atmospheric pressure data for the specified time range and source
-    """    
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
-    print(f"get_atm_pressure wrapper: atm_id={atm_id}, atm_src={atm_src}, begin_date={begin_date}, end_date={end_date}")
+        list: List of (begin, end) tuples still to be retrieved
+    """
+    missing = []
+    cursor = begin
+    for covered_begin, covered_end in coverage:
+        if covered_end < cursor:
+            continue
+        if covered_begin > end:
+            break
+        if covered_begin > cursor:
+            missing.append((cursor, covered_begin))
+        cursor = max(cursor, covered_end)
+    if cursor < end:
+        missing.append((cursor, end))
+    return missing
 
-    match atm_src.upper():
-        case "NOAA":
-            return get_noaa_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
-        case "NWS":
-            return get_nws_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
-        case "ISU":
-            return get_isu_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
-        case "FIMAN":
-            return get_fiman_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
-        case _:
-            return "No valid `atm_src` provided! Make sure you are supplying a string"
-        
-        
-def interpolate_atm_data(x, debug = True):
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
-    place_names = list(x["place"].unique())
-    
-    interpolated_data = pd.DataFrame()
-    
-    for selected_place in place_names:
-        print("for " + selected_place)
-        
-        selected_data = x.query("place == @selected_place").copy()
-        selected_data["pressure_mb"] = np.nan
-        
-        dt_range = [selected_data["date"].min() - timedelta(seconds = 1800), selected_data["date"].max() + timedelta(seconds = 1800)]
-        dt_duration = dt_range[1] - dt_range[0]
-        dt_min = dt_range[0]
-        dt_max = dt_range[1]
-        
-        # Shouldn't ever hit this block since the time range on the inital request is limited to 14 days
-        if dt_duration >= timedelta(days=30):
-            chunks = int(np.ceil(dt_duration / timedelta(days=30)))
-            span = dt_duration / chunks
-            
-            atm_data = pd.DataFrame()
-            for i in range(1, chunks + 1):
-                range_min = dt_min + (span * (i-1))
-                range_max = dt_min + (span * i)
-                
-                #print(selected_data.to_string())    # FOR DEBUGGING
-                print(f"Retrieving atm data for chunk {i}/{chunks} for {selected_place}")
-                print(f"  range_min={range_min}, range_max={range_max}")
-                d = get_atm_pressure(atm_id = selected_data["atm_station_id"].unique()[0], 
-                                            atm_src = selected_data["atm_data_src"].unique()[0], 
-                                            begin_date = range_min.strftime("%Y%m%d %H:%M"),
-                                            end_date = range_max.strftime("%Y%m%d %H:%M"))
-                print(f"  chunk {i} atm rows:", d.shape[0])
-                
-                atm_data = pd.concat([atm_data, d]).drop_duplicates()
-                
-        if dt_duration < timedelta(days=30):      
-                atm_data = get_atm_pressure(atm_id = selected_data["atm_station_id"].unique()[0], 
-                                            atm_src = selected_data["atm_data_src"].unique()[0], 
-                                            begin_date = dt_min.strftime("%Y%m%d %H:%M"),
-                                            end_date = dt_max.strftime("%Y%m%d %H:%M")).drop_duplicates()     
+
+class AtmPressureStore:
+    """Persistent atmospheric pressure store in Postgres, keyed by (source, station)
+
+    `atm_pressure_cache` holds the observations and `atm_pressure_cache_coverage` the time
+    ranges that have already been retrieved, so only the missing parts of a request (normally
+    the last few minutes) are asked of the provider. Coverage is only recorded up to the last
+    observation a provider returned, so data that was not yet published is asked for again.
+    """
+
+    # FIMAN pressure already lives in our own `api_data` table
+    sources = {"NOAA", "NWS", "ISU"}
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def ensure_tables(self):
+        """Create the store tables if they don't exist yet"""
+        with self.engine.begin() as conn:
+            for ddl in ATM_STORE_DDL:
+                conn.execute(text(ddl))
+
+    def coverage(self, atm_src, atm_id):
+        """Covered time ranges for a station
+
+        Returns:
+            list: Sorted, non-overlapping list of (begin, end) tuples
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT begin_date, end_date FROM atm_pressure_cache_coverage "
+                                     "WHERE src = :src AND station_id = :station_id ORDER BY begin_date"),
+                                {"src": atm_src, "station_id": atm_id}).fetchall()
+        return merge_intervals([(pd.Timestamp(b).tz_convert("UTC"), pd.Timestamp(e).tz_convert("UTC")) for b, e in rows])
+
+    def load(self, atm_src, atm_id, begin, end):
+        """Stored observations for a station between `begin` and `end`, in the format the providers return"""
+        query = text("SELECT station_id AS id, date, pressure_mb, notes FROM atm_pressure_cache "
+                     "WHERE src = :src AND station_id = :station_id AND date >= :begin AND date <= :end ORDER BY date")
+        with self.engine.connect() as conn:
+            r_df = pd.read_sql_query(query, conn, params = {"src": atm_src, "station_id": atm_id,
+                                                            "begin": begin.to_pydatetime(), "end": end.to_pydatetime()})
+        r_df["date"] = pd.to_datetime(r_df["date"], utc = True)
+        return r_df
+
+    def save(self, atm_src, atm_id, atm_data, begin):
+        """Store the observations returned for a request starting at `begin` and extend the coverage up to the last one"""
+        if atm_data.empty:
+            return
+
+        rows = atm_data.loc[:, ["date", "pressure_mb", "notes"]].drop_duplicates(subset = "date", keep = "last").copy()
+        rows["pressure_mb"] = pd.to_numeric(rows["pressure_mb"], errors = "coerce")
+        rows.insert(0, "station_id", atm_id)
+        rows.insert(0, "src", atm_src)
+
+        covered_until = rows["date"].max()
+
+        with self.engine.begin() as conn:
+            rows.to_sql("atm_pressure_cache", conn, if_exists = "append", index = False, method = postgres_upsert)
+
+            existing = conn.execute(text("SELECT begin_date, end_date FROM atm_pressure_cache_coverage "
+                                         "WHERE src = :src AND station_id = :station_id FOR UPDATE"),
+                                    {"src": atm_src, "station_id": atm_id}).fetchall()
+            intervals = [(pd.Timestamp(b).tz_convert("UTC"), pd.Timestamp(e).tz_convert("UTC")) for b, e in existing]
+            if covered_until >= begin:
+                intervals.append((begin, covered_until))
+
+            conn.execute(text("DELETE FROM atm_pressure_cache_coverage WHERE src = :src AND station_id = :station_id"),
+                         {"src": atm_src, "station_id": atm_id})
+            for b, e in merge_intervals(intervals):
+                conn.execute(text("INSERT INTO atm_pressure_cache_coverage (src, station_id, begin_date, end_date) "
+                                  "VALUES (:src, :station_id, :begin, :end)"),
+                             {"src": atm_src, "station_id": atm_id, "begin": b.to_pydatetime(), "end": e.to_pydatetime()})
+
+    def get_atm_pressure(self, atm_id, atm_src, begin_date, end_date):
+        """Serve a request from the store, asking the provider only for the ranges not covered yet
+
+        Args:
+            atm_id (str): ID of the atmospheric pressure station
+            atm_src (str): Source of the atmospheric pressure data
+            begin_date (str): The beginning date to retrieve data. Format: %Y%m%d %H:%M
+            end_date (str): The end date to retrieve data. Format: %Y%m%d %H:%M
+
+        Returns:
+            pandas.DataFrame: Atmospheric pressure data for the specified time range and source
+        """
+        atm_src = str(atm_src).upper()
+        atm_id = str(atm_id)
+        # Cover the whole span the provider would return, so padded sources keep the observations around the window
+        lower, upper = _atm_request_bounds(atm_src, begin_date, end_date)
+
+        for missing_begin, missing_end in missing_intervals(self.coverage(atm_src, atm_id), lower, upper):
+            print(f"atm store: fetching {atm_src} station {atm_id} from {missing_begin} to {missing_end}")
+            d = self.fetch(atm_id = atm_id,
+                           atm_src = atm_src,
+                           begin_date = missing_begin.strftime("%Y%m%d %H:%M"),
+                           end_date = missing_end.strftime("%Y%m%d %H:%M"))
+            if isinstance(d, pd.DataFrame):
+                self.save(atm_src, atm_id, d, missing_begin)
+
+        return self.load(atm_src, atm_id, lower, upper)
+
+    def fetch(self, atm_id, atm_src, begin_date, end_date):
+        """Retrieve a range that is not in the store"""
+        return get_atm_pressure(atm_id = atm_id, atm_src = atm_src, begin_date = begin_date, end_date = end_date)
+
+
+class MemoryAtmPressureStore(AtmPressureStore):
+    """In-memory atmospheric pressure store, kept warm between cycles in `--serve` mode
+
+    Ranges it doesn't hold come from `backing` (normally the Postgres store) if there is one,
+    otherwise from the provider. Observations older than `retention` are dropped.
+    """
+
+    def __init__(self, backing = None, retention = timedelta(days = 15)):
+        self.backing = backing
+        self.retention = retention
+        self.data = {}
+        self.covered = {}
+        self.lock = threading.Lock()
+
+    def ensure_tables(self):
+        pass
+
+    def coverage(self, atm_src, atm_id):
+        with self.lock:
+            return list(self.covered.get((atm_src, atm_id), []))
+
+    def load(self, atm_src, atm_id, begin, end):
+        with self.lock:
+            atm_data = self.data.get((atm_src, atm_id), pd.DataFrame(columns = ["id", "date", "pressure_mb", "notes"]))
+            return atm_data.loc[(atm_data["date"] >= begin) & (atm_data["date"] <= end)].copy()
+
+    def save(self, atm_src, atm_id, atm_data, begin):
+        if atm_data.empty:
+            return
+
+        rows = atm_data.loc[:, ["id", "date", "pressure_mb", "notes"]].assign(id = atm_id, pressure_mb = pd.to_numeric(atm_data["pressure_mb"], errors = "coerce"))
+        covered_until = rows["date"].max()
+        oldest = pd.Timestamp.now(tz = "UTC") - self.retention
+
+        with self.lock:
+            key = (atm_src, atm_id)
+            rows = pd.concat([self.data.get(key, pd.DataFrame()), rows]).drop_duplicates(subset = "date", keep = "last").sort_values("date")
+            self.data[key] = rows.loc[rows["date"] >= oldest].reset_index(drop = True)
+
+            intervals = self.covered.get(key, []) + ([(begin, covered_until)] if covered_until >= begin else [])
+            self.covered[key] = [(max(b, oldest), e) for b, e in merge_intervals(intervals) if e >= oldest]
+
+    def fetch(self, atm_id, atm_src, begin_date, end_date):
+        if self.backing is not None:
+            return self.backing.get_atm_pressure(atm_id = atm_id, atm_src = atm_src, begin_date = begin_date, end_date = end_date)
+        return super().fetch(atm_id = atm_id, atm_src = atm_src, begin_date = begin_date, end_date = end_date)
+
+
+def get_atm_store(engine):
+    """The persistent atmospheric pressure store, unless disabled with `ATM_STORE=off`
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+
+    Returns:
+        AtmPressureStore: The store, or None if it is disabled or its tables can't be created
+    """
+    if os.environ.get("ATM_STORE", "postgres").lower() in ("off", "false", "0", "none"):
+        return None
+
+    store = AtmPressureStore(engine)
+    try:
+        store.ensure_tables()
+    except Exception as ex:
+        warnings.warn("Atmospheric pressure store unavailable; requesting full windows from the providers")
+        print(f"get_atm_store error: {type(ex).__name__}: {ex}")
+        return None
+    return store
+
+
+###########################
+# Station health          #
+###########################
+
+STATION_HEALTH_DDL = """CREATE TABLE IF NOT EXISTS atm_station_health (
+        src text NOT NULL,
+        station_id text NOT NULL,
+        latency_ms double precision,
+        failures integer NOT NULL DEFAULT 0,
+        last_success timestamptz,
+        last_observation timestamptz,
+        open_until timestamptz,
+        updated_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (src, station_id)
+    )"""
+
+# Consecutive failed requests that open a station's circuit, and the cool-off (minutes) before it is
+# probed again. Each failed probe doubles the cool-off, up to the maximum
+CIRCUIT_FAILURES = int(os.environ.get("SDFP_CIRCUIT_FAILURES", 3))
+CIRCUIT_COOL_OFF = timedelta(minutes = float(os.environ.get("SDFP_CIRCUIT_COOL_OFF_MINUTES", 5)))
+CIRCUIT_MAX_COOL_OFF = timedelta(minutes = float(os.environ.get("SDFP_CIRCUIT_MAX_COOL_OFF_MINUTES", 360)))
+
+
+class StationHealth:
+    """Health of each (source, station) with a circuit breaker, kept across runs
+
+    Every request records its latency (as a moving average), whether it failed, and the last
+    observation it returned. A request fails when it returns nothing, or nothing within
+    `stale_after` of the end of the requested window. After `CIRCUIT_FAILURES` failures in a row
+    the station's circuit opens, and places that have a backup go straight to it. Once the cool-off
+    passes the station is probed again: a success closes the circuit, a failure doubles the cool-off.
+
+    Records are kept in `atm_station_health` when an engine is given, and only in memory otherwise.
+    """
+
+    stale_after = timedelta(hours = 3)
+
+    def __init__(self, engine = None):
+        self.engine = engine
+        self.records = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def ensure_tables(self):
+        """Create the health table if it doesn't exist yet"""
+        with self.engine.begin() as conn:
+            conn.execute(text(STATION_HEALTH_DDL))
+
+    def load(self):
+        """Read every station's record from the database"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT src, station_id, latency_ms, failures, last_success, last_observation, open_until "
+                                     "FROM atm_station_health")).mappings().fetchall()
+        with self.lock:
+            for row in rows:
+                record = {k: (pd.Timestamp(v).tz_convert("UTC") if isinstance(v, datetime) else v) for k, v in row.items()}
+                self.records[(record.pop("src"), record.pop("station_id"))] = record
+
+    def record(self, key, atm_data, requested_end, seconds):
+        """Record the outcome of a request
+
+        Args:
+            key (tuple): (atm_src, atm_id), as in the fetch plan
+            atm_data (pd.DataFrame): What the request returned
+            requested_end (pd.Timestamp): End of the requested window
+            seconds (float): How long the request took
+        """
+        now = pd.Timestamp.now(tz = "UTC")
+        last_observation = None if atm_data.empty else atm_data["date"].max()
+        ok = last_observation is not None and requested_end - last_observation < self.stale_after
+
+        with self.lock:
+            record = self.records.setdefault(key, {"latency_ms": None, "failures": 0, "last_success": None,
+                                                   "last_observation": None, "open_until": None})
+            latency_ms = seconds * 1000
+            record["latency_ms"] = latency_ms if record["latency_ms"] is None else 0.8 * record["latency_ms"] + 0.2 * latency_ms
+            if last_observation is not None and (record["last_observation"] is None or last_observation > record["last_observation"]):
+                record["last_observation"] = last_observation
+
+            if ok:
+                if record["open_until"] is not None:
+                    print(f"Circuit closed for {key[0]} station {key[1]}")
+                record.update(failures = 0, last_success = now, open_until = None)
+            else:
+                record["failures"] += 1
+                if record["failures"] >= CIRCUIT_FAILURES:
+                    cool_off = min(CIRCUIT_MAX_COOL_OFF, CIRCUIT_COOL_OFF * 2 ** (record["failures"] - CIRCUIT_FAILURES))
+                    record["open_until"] = now + cool_off
+                    metrics.count("circuit_open_total", source = key[0])
+                    print(f"Circuit open for {key[0]} station {key[1]} after {record['failures']} failures; next probe after {record['open_until']}")
+            self.dirty.add(key)
+
+    def is_open(self, key):
+        """Whether requests to a station should be skipped for now"""
+        with self.lock:
+            open_until = self.records.get(key, {}).get("open_until")
+        return open_until is not None and pd.Timestamp.now(tz = "UTC") < open_until
+
+    def save(self):
+        """Write the records changed since the last save"""
+        if self.engine is None:
+            return
+
+        with self.lock:
+            rows = [{"src": key[0], "station_id": key[1], **{k: (v.to_pydatetime() if isinstance(v, pd.Timestamp) else v) for k, v in self.records[key].items()}}
+                    for key in self.dirty]
+            self.dirty = set()
+
+        if len(rows) == 0:
+            return
+
+        with self.engine.begin() as conn:
+            conn.execute(text("INSERT INTO atm_station_health (src, station_id, latency_ms, failures, last_success, last_observation, open_until, updated_at) "
+                              "VALUES (:src, :station_id, :latency_ms, :failures, :last_success, :last_observation, :open_until, now()) "
+                              "ON CONFLICT (src, station_id) DO UPDATE SET latency_ms = EXCLUDED.latency_ms, failures = EXCLUDED.failures, "
+                              "last_success = EXCLUDED.last_success, last_observation = EXCLUDED.last_observation, "
+                              "open_until = EXCLUDED.open_until, updated_at = now()"),
+                         rows)
+
+
+def get_station_health(engine):
+    """Station health records, unless circuit breaking is disabled with `SDFP_CIRCUIT_BREAKER=off`
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+
+    Returns:
+        StationHealth: The records, kept in memory only if the table can't be used. None if disabled
+    """
+    if os.environ.get("SDFP_CIRCUIT_BREAKER", "on").lower() in ("off", "false", "0", "none"):
+        return None
+
+    health = StationHealth(engine)
+    try:
+        health.ensure_tables()
+        health.load()
+    except Exception as ex:
+        warnings.warn("Station health table unavailable; circuit breaking for this run only")
+        print(f"get_station_health error: {type(ex).__name__}: {ex}")
+        return StationHealth()
+    return health
+
+
+#####################
+# atm API functions #
+#####################
+
+def get_atm_pressure(atm_id, atm_src, begin_date, end_date, store = None):
+    """Yo, yo, yo, it's a wrapper function!
+
+    Args:
+        atm_id (str): Value from `sensor_surveys` table that declares the ID of the station to use for atmospheric pressure data.
+        atm_src (str): Value from `sensor_surveys` table that declares the source of the atmospheric pressure data.
+        begin_date (str): The beginning date to retrieve data. Format: %Y%m%d %H:%M
+        end_date (str): The end date to retrieve data. Format: %Y%m%d %H:%M
+        store (AtmPressureStore, optional): Persistent store to serve the request from. Only the missing ranges are requested from the provider
+
+    Returns:
+        pandas.DataFrame: Atmospheric pressure data for the specified time range and source
+    """    
+    print(f"get_atm_pressure wrapper: atm_id={atm_id}, atm_src={atm_src}, begin_date={begin_date}, end_date={end_date}")
+
+    if store is not None and str(atm_src).upper() in store.sources:
+        atm_data = store.get_atm_pressure(atm_id = atm_id, atm_src = atm_src, begin_date = begin_date, end_date = end_date)
+    else:
+        match atm_src.upper():
+            case "NOAA":
+                atm_data = get_noaa_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
+            case "NWS":
+                atm_data = get_nws_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
+            case "ISU":
+                atm_data = get_isu_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
+            case "FIMAN":
+                atm_data = get_fiman_atm(id = atm_id, begin_date = begin_date, end_date = end_date)
+            case _:
+                atm_data = "No valid `atm_src` provided! Make sure you are supplying a string"
+
+    if capture is not None:
+        capture.save_atm(atm_id, atm_src, begin_date, end_date, atm_data)
+    return atm_data
+        
+        
+def _atm_request_bounds(atm_src, begin_date, end_date):
+    """Span of observations a provider returns for a request, used to slice shared station data back to a single place
+
+    Args:
+        atm_src (str): Source of the atmospheric pressure data
+        begin_date (str): The beginning date of the request. Format: %Y%m%d %H:%M
+        end_date (str): The end date of the request. Format: %Y%m%d %H:%M
+
+    Returns:
+        tuple: (pd.Timestamp, pd.Timestamp) lower and upper bound of the returned observations, UTC
+    """
+    begin = pd.to_datetime(begin_date, utc=True)
+    end = pd.to_datetime(end_date, utc=True)
+
+    match str(atm_src).upper():
+        case "NWS" | "FIMAN":
+            return begin - timedelta(seconds = 3600), end + timedelta(seconds = 3600)
+        case "ISU":
+            return begin - ISU_PADDING, end + ISU_PADDING
+        case _:
+            return begin, end
+
+
+def get_atm_window(atm_id, atm_src, dt_min, dt_max, store = None):
+    """Retrieve atmospheric pressure for a time window, splitting windows of 30 days or more into chunks
+
+    Args:
+        atm_id (str): ID of the atmospheric pressure station
+        atm_src (str): Source of the atmospheric pressure data
+        dt_min (pd.Timestamp): Beginning of the window
+        dt_max (pd.Timestamp): End of the window
+        store (AtmPressureStore, optional): Persistent store passed on to `get_atm_pressure`
+
+    Returns:
+        pandas.DataFrame: Atmospheric pressure data for the window. Empty if nothing could be retrieved
+    """
+    dt_duration = dt_max - dt_min
+    chunks = int(np.ceil(dt_duration / timedelta(days=30))) if dt_duration >= timedelta(days=30) else 1
+    span = dt_duration / chunks
+
+    atm_data = pd.DataFrame()
+    for i in range(1, chunks + 1):
+        range_min = dt_min + (span * (i-1))
+        range_max = dt_min + (span * i)
+
+        if chunks > 1:
+            print(f"Retrieving atm data for chunk {i}/{chunks} for {atm_src} station {atm_id}")
+            print(f"  range_min={range_min}, range_max={range_max}")
+
+        d = get_atm_pressure(atm_id = atm_id,
+                             atm_src = atm_src,
+                             begin_date = range_min.strftime("%Y%m%d %H:%M"),
+                             end_date = range_max.strftime("%Y%m%d %H:%M"),
+                             store = store)
+
+        if not isinstance(d, pd.DataFrame):
+            warnings.warn(message = f"{d} (station {atm_id}, source {atm_src})")
+            return pd.DataFrame()
+
+        atm_data = pd.concat([atm_data, d])
+
+    return atm_data.drop_duplicates()
+
+
+def plan_atm_fetches(x, station_col = "atm_station_id", src_col = "atm_data_src"):
+    """Group places by atmospheric pressure station so that each station is only requested once per run
+
+    Args:
+        x (pd.DataFrame): Measurements matched to surveys. Must contain `place`, `date` and the station and source columns
+        station_col (str): Column holding the station id
+        src_col (str): Column holding the source of the atmospheric pressure data
+
+    Returns:
+        dict: {(atm_src, atm_id): {"atm_id", "atm_src", "begin", "end", "places"}} where `begin`/`end` span the union of the places' windows
+    """
+    plan = {}
+
+    for selected_place, selected_data in x.groupby("place", observed = True, sort = False):
+        atm_id = selected_data[station_col].unique()[0]
+        atm_src = selected_data[src_col].unique()[0]
+
+        if pd.isna(atm_src) or not atm_src:
+            continue
+
+        dt_min = selected_data["date"].min() - timedelta(seconds = 1800)
+        dt_max = selected_data["date"].max() + timedelta(seconds = 1800)
+
+        key = (str(atm_src).upper(), str(atm_id))
+        if key not in plan:
+            plan[key] = {"atm_id": atm_id, "atm_src": atm_src, "begin": dt_min, "end": dt_max, "places": []}
+
+        plan[key]["begin"] = min(plan[key]["begin"], dt_min)
+        plan[key]["end"] = max(plan[key]["end"], dt_max)
+        plan[key]["places"].append(selected_place)
+
+    return plan
+
+
+def fetch_atm_station(key, job, store = None, health = None):
+    """Retrieve one planned station's window. Errors are reported and give an empty frame
+
+    Returns:
+        dict: {key: pd.DataFrame}
+    """
+    start = time.perf_counter()
+    try:
+        atm_data = get_atm_window(job["atm_id"], job["atm_src"], job["begin"], job["end"], store)
+    except Exception as e:
+        print(f"fetch_atm_station error for {key[0]} station {key[1]}: {type(e).__name__}: {e}")
+        atm_data = pd.DataFrame()
+    print(f"  {key[0]} station {key[1]} atm rows: {atm_data.shape[0]}")
+
+    if health is not None:
+        health.record(key, atm_data, job["end"], time.perf_counter() - start)
+    return {key: atm_data}
+
+
+def fetch_fiman_stations(windows, health = None):
+    """Retrieve planned FIMAN stations with one `get_fiman_atm_batch` query
+
+    Returns:
+        dict: {("FIMAN", id): pd.DataFrame}
+    """
+    start = time.perf_counter()
+    results = {}
+    for id, atm_data in get_fiman_atm_batch(windows).items():
+        results[("FIMAN", id)] = atm_data
+        print(f"  FIMAN station {id} atm rows: {atm_data.shape[0]}")
+        if capture is not None:
+            capture.save_atm(id, "FIMAN", windows[id][0], windows[id][1], atm_data)
+
+        if health is not None:
+            health.record(("FIMAN", id), atm_data, pd.to_datetime(windows[id][1], utc = True), time.perf_counter() - start)
+    return results
+
+
+def submit_atm_plan(pool, plan, store = None, health = None):
+    """Start retrieving every station in a fetch plan on a thread pool
+
+    `provider_get` keeps each provider within its limits in `PROVIDER_LIMITS`.
+
+    Args:
+        pool (ThreadPoolExecutor): Pool to run the requests on
+        plan (dict): Output of `plan_atm_fetches`, or part of it
+        store (AtmPressureStore, optional): Persistent store passed on to `get_atm_pressure`
+        health (StationHealth, optional): Records the outcome of each station's request
+
+    Returns:
+        dict: {(atm_src, atm_id): Future}. Each future returns {(atm_src, atm_id): pd.DataFrame};
+            FIMAN stations share one future, since they all come from one `api_data` query, unless `store` serves FIMAN
+    """
+    futures = {}
+    fiman_windows = {}
+    for key, job in plan.items():
+        print(f"Retrieving atm data for {key[0]} station {key[1]} ({len(job['places'])} place(s): {', '.join(job['places'])})")
+        if key[0] == "FIMAN" and (store is None or "FIMAN" not in store.sources):
+            fiman_windows[key[1]] = (job["begin"].strftime("%Y%m%d %H:%M"), job["end"].strftime("%Y%m%d %H:%M"))
+        else:
+            futures[key] = pool.submit(fetch_atm_station, key, job, store, health)
+
+    if len(fiman_windows) > 0:
+        fiman_future = pool.submit(fetch_fiman_stations, fiman_windows, health)
+        futures.update({("FIMAN", id): fiman_future for id in fiman_windows})
+
+    return futures
+
+
+def fetch_atm_plan(plan, atm_cache = None, max_workers = ATM_FETCH_WORKERS, store = None, health = None):
+    """Retrieve the atmospheric pressure for every station in a fetch plan concurrently
+
+    All stations are requested at once, so the run takes as long as the slowest station.
+
+    Args:
+        plan (dict): Output of `plan_atm_fetches`
+        atm_cache (dict, optional): Per-run cache of {(atm_src, atm_id): pd.DataFrame} to fill. A new one is created if not supplied
+        max_workers (int): Maximum number of stations requested at the same time
+        store (AtmPressureStore, optional): Persistent store passed on to `get_atm_pressure`
+        health (StationHealth, optional): Records the outcome of each station's request
+
+    Returns:
+        dict: The cache, with one entry per planned station
+    """
+    if atm_cache is None:
+        atm_cache = {}
+
+    if len(plan) == 0:
+        return atm_cache
+
+    with ThreadPoolExecutor(max_workers = max(1, min(max_workers, len(plan)))) as pool:
+        for future in dict.fromkeys(submit_atm_plan(pool, plan, store, health).values()):
+            atm_cache.update(future.result())
+
+    return atm_cache
+
+
+# Seconds to wait on a place's primary atm source before its backup is requested as well. "off" only
+# requests the backup once the primary has come back without usable data
+ATM_HEDGE_DELAY = os.environ.get("SDFP_HEDGE_DELAY", "10")
+ATM_HEDGE_DELAY = None if ATM_HEDGE_DELAY.lower() in ("", "off") else float(ATM_HEDGE_DELAY)
+
+
+def atm_covers(atm_data, until, max_gap = timedelta(seconds = 3600)):
+    """Whether atm data reaches `until`, or close enough that `extrapolate_atm_data` will"""
+    return not atm_data.empty and (until - atm_data["date"].max()) < max_gap
+
+
+def atm_usable(atm_data, since):
+    """Whether atm data is non-empty and not stale, i.e. reaches at least `since`"""
+    return not atm_data.empty and atm_data["date"].max() >= since
+
+
+def resolve_atm_sources(x, hedge_delay = ATM_HEDGE_DELAY, max_workers = ATM_FETCH_WORKERS, store = None, health = None):
+    """Choose every place's atmospheric pressure source as its requests come back, hedging slow primary sources with their backups
+
+    Every place's primary station is requested at once. A place is hedged once its primary has come
+    back without data covering the place's latest measurement, or has not come back within
+    `hedge_delay` seconds; only then is its backup station requested, for the windows of the places
+    that use it as a backup, and considered. The first of the two to cover the latest measurement
+    wins. If neither does, the primary is used unless it is empty or stale. A backup station that is
+    also another place's primary doesn't count until this place is hedged, and is requested again
+    for the backup windows rather than reusing that place's data.
+
+    Stations whose circuit is open in `health` are not requested at all, so a place with an open
+    primary goes straight to its backup. Rows left without atm data stay pending and are read
+    again next run.
+
+    Args:
+        x (pd.DataFrame): Measurements matched to surveys
+        hedge_delay (float): Seconds to wait on a primary before requesting the backup. None waits for the primary
+        max_workers (int): Maximum number of stations requested at the same time
+        store (AtmPressureStore, optional): Persistent store passed on to `get_atm_pressure`
+        health (StationHealth, optional): Station health records and circuit breaker. Saved once every place has a source
+
+    Yields:
+        tuple: (atm_data, sources) each time places get their source, for the places decided since the last
+            yield. `atm_data` is {place: pd.DataFrame}, the place's window of its chosen source, and `sources` is
+            {place: (role, atm_src, atm_id)} with role "primary" or "backup"
+    """
+    places = {}
+    for selected_place, selected_data in x.groupby("place", observed = True, sort = False):
+        alt_src = selected_data["alt_atm_data_src"].unique()[0]
+        places[selected_place] = {
+            "primary": (selected_data["atm_data_src"].unique()[0], selected_data["atm_station_id"].unique()[0]),
+            "backup": None if pd.isna(alt_src) or not alt_src else (alt_src, selected_data["alt_atm_station_id"].unique()[0]),
+            "first": selected_data["date"].min(),
+            "last": selected_data["date"].max(),
+            "hedged": False}
+
+    def plan_key(source):
+        return (str(source[0]).upper(), str(source[1]))
+
+    def circuit_open(source):
+        return health is not None and health.is_open(plan_key(source))
+
+    skip_primary = [p for p, v in places.items() if circuit_open(v["primary"])]
+    for selected_place in skip_primary:
+        print(f"Circuit open for {selected_place}'s primary source {places[selected_place]['primary']}; skipping it")
+        metrics.count("circuit_skips_total", source = plan_key(places[selected_place]["primary"])[0])
+
+    primary_plan = plan_atm_fetches(x.loc[~x["place"].isin(skip_primary)])
+    backup_plan = plan_atm_fetches(x.loc[x["place"].isin([p for p, v in places.items() if v["backup"] is not None])],
+                                   station_col = "alt_atm_station_id", src_col = "alt_atm_data_src")
+
+    pool = ThreadPoolExecutor(max_workers = max(1, min(max_workers, len(primary_plan) + len(backup_plan))))
+    futures = submit_atm_plan(pool, primary_plan, store, health)
+    backup_futures = {}
+    deadline = None if hedge_delay is None else time.monotonic() + hedge_delay
+
+    def fetched(requests, source, place):
+        """The place's slice of a source's data, or None while it is still being requested"""
+        future = requests.get(plan_key(source))
+        if future is not None and not future.done():
+            return None
+        atm_cache = future.result() if future is not None else {}
+        return slice_atm_data(atm_cache, atm_id = source[1], atm_src = source[0],
+                              dt_min = place["first"] - timedelta(seconds = 1800),
+                              dt_max = place["last"] + timedelta(seconds = 1800))
+
+    sources = {}
+    try:
+        while len(sources) < len(places):
+            hedges = {}
+            decided = {}
+            atm_data = {}
+            for selected_place, place in places.items():
+                if selected_place in sources:
+                    continue
+
+                primary = fetched(futures, place["primary"], place)
+                if place["backup"] is not None and not place["hedged"] and (
+                        (primary is not None and not atm_covers(primary, place["last"]))
+                        or (primary is None and deadline is not None and time.monotonic() >= deadline)):
+                    place["hedged"] = True
+                    backup_key = plan_key(place["backup"])
+                    if circuit_open(place["backup"]):
+                        print(f"Circuit open for {selected_place}'s backup source {place['backup']}; skipping it")
+                    elif backup_key not in backup_futures and backup_key not in hedges:
+                        print(f"Requesting backup source for {selected_place}: primary {'came back without coverage' if primary is not None else 'is slow'}")
+                        metrics.count("atm_hedges_total", source = plan_key(place["primary"])[0])
+                        hedges[backup_key] = backup_plan[backup_key]
+
+                # A backup is only considered once the place is hedged, and not before its own request is out
+                backup = None
+                if place["hedged"] and plan_key(place["backup"]) not in hedges:
+                    backup = fetched(backup_futures, place["backup"], place)
+
+                if primary is not None and atm_covers(primary, place["last"]):
+                    decided[selected_place], atm_data[selected_place] = ("primary",) + place["primary"], primary
+                elif backup is not None and atm_covers(backup, place["last"]):
+                    decided[selected_place], atm_data[selected_place] = ("backup",) + place["backup"], backup
+                elif place["backup"] is None:
+                    if primary is not None:
+                        decided[selected_place], atm_data[selected_place] = ("primary",) + place["primary"], primary
+                elif primary is not None and backup is not None:
+                    if not atm_usable(primary, place["first"]) and atm_usable(backup, place["first"]):
+                        decided[selected_place], atm_data[selected_place] = ("backup",) + place["backup"], backup
+                    else:
+                        decided[selected_place], atm_data[selected_place] = ("primary",) + place["primary"], primary
+
+            # Hedges go out before the decided places are handed over, so they are requested meanwhile
+            if len(hedges) > 0:
+                backup_futures.update(submit_atm_plan(pool, hedges, store, health))
+
+            if len(decided) > 0:
+                sources.update(decided)
+                for selected_place, (role, atm_src, atm_id) in decided.items():
+                    metrics.count("atm_source_total", role = role, source = str(atm_src).upper())
+                    print(f"  {selected_place}: using {role} source {atm_src} station {atm_id}")
+                if capture is not None:
+                    capture.save_sources(atm_data, decided)
+                yield atm_data, decided
+
+            if len(hedges) > 0:
+                continue
+
+            if len(sources) < len(places):
+                timeout = None if deadline is None or time.monotonic() >= deadline else deadline - time.monotonic()
+                pending = [f for f in list(futures.values()) + list(backup_futures.values()) if not f.done()]
+                wait(pending, timeout = timeout, return_when = FIRST_COMPLETED)
+    finally:
+        # Don't hold the run up for the losers
+        pool.shutdown(wait = False, cancel_futures = True)
+
+    if health is not None:
+        try:
+            health.save()
+        except Exception as ex:
+            print(f"Station health save error: {type(ex).__name__}: {ex}")
+
+
+def fetch_atm_hedged(x, hedge_delay = ATM_HEDGE_DELAY, max_workers = ATM_FETCH_WORKERS, store = None, health = None):
+    """Retrieve atmospheric pressure for every place, waiting until every place has a source (see `resolve_atm_sources`)
+
+    Returns:
+        tuple: (atm_data, sources) where `atm_data` is {place: pd.DataFrame}, the place's window of its chosen
+            source, and `sources` is {place: (role, atm_src, atm_id)} with role "primary" or "backup"
+    """
+    atm_data, sources = {}, {}
+    for decided_data, decided in resolve_atm_sources(x, hedge_delay = hedge_delay, max_workers = max_workers, store = store, health = health):
+        atm_data.update(decided_data)
+        sources.update(decided)
+    return atm_data, sources
+
+
+def slice_atm_data(atm_cache, atm_id, atm_src, dt_min, dt_max):
+    """Cut a single place's window out of the cached data of its station
+
+    Args:
+        atm_cache (dict): Output of `fetch_atm_plan`
+        atm_id (str): ID of the atmospheric pressure station
+        atm_src (str): Source of the atmospheric pressure data
+        dt_min (pd.Timestamp): Beginning of the place's window
+        dt_max (pd.Timestamp): End of the place's window
+
+    Returns:
+        pandas.DataFrame: The rows a direct request for the place's window would have returned
+    """
+    atm_data = atm_cache.get((str(atm_src).upper(), str(atm_id)), pd.DataFrame())
+
+    if atm_data.empty:
+        return atm_data
+
+    lower, upper = _atm_request_bounds(atm_src, dt_min.strftime("%Y%m%d %H:%M"), dt_max.strftime("%Y%m%d %H:%M"))
+
+    return atm_data.loc[(atm_data["date"] >= lower) & (atm_data["date"] <= upper)]
+        
+        
+def epoch_ns(dates):
+    """int64 nanoseconds since the epoch (UTC) for a Series/array of datetimes"""
+    return pd.DatetimeIndex(dates).asi8
+
+
+def interpolate_groups(sample_groups, sample_times, ref_groups, ref_times, ref_values):
+    """Time-weighted linear interpolation of many independent series in one pass
+
+    Each sample is interpolated only against the reference points of its own group, with
+    the same results as `interpolate(method='time')` on a frame of one group's samples and
+    references: samples before a group's first valid reference stay NaN and samples after
+    its last valid reference take that value.
+
+    Args:
+        sample_groups (np.ndarray): Group number of each sample
+        sample_times (np.ndarray): int64 epoch time of each sample
+        ref_groups (np.ndarray): Group number of each reference point
+        ref_times (np.ndarray): int64 epoch time of each reference point
+        ref_values (np.ndarray): Value of each reference point. NaN values are skipped
+
+    Returns:
+        np.ndarray: Interpolated value of each sample, in the order given
+    """
+    result = np.full(len(sample_times), np.nan)
+
+    valid = ~np.isnan(ref_values)
+    ref_groups, ref_times, ref_values = ref_groups[valid], ref_times[valid], ref_values[valid]
+
+    ref_order = np.lexsort((ref_times, ref_groups))
+    ref_groups, ref_times, ref_values = ref_groups[ref_order], ref_times[ref_order], ref_values[ref_order]
+
+    sample_order = np.argsort(sample_groups, kind = "stable")
+    sorted_sample_groups = sample_groups[sample_order]
+
+    for group in np.unique(sorted_sample_groups):
+        r0, r1 = np.searchsorted(ref_groups, [group, group + 1])
+        if r0 == r1:
+            continue
+        s0, s1 = np.searchsorted(sorted_sample_groups, [group, group + 1])
+        positions = sample_order[s0:s1]
+
+        t = sample_times[positions]
+        values = np.interp(t, ref_times[r0:r1], ref_values[r0:r1])
+        values[t < ref_times[r0]] = np.nan
+        result[positions] = values
+
+    return result
+
+
+def extrapolate_linear(times, values, steps):
+    """Continue the line through the last two points
+
+    Args:
+        times (np.ndarray): int64 epoch times of the atm series, sorted
+        values (np.ndarray): Pressure values of the atm series
+        steps (np.ndarray): 1, 2, ..., n
+
+    Returns:
+        np.ndarray: Pressure values of the n extrapolated points
+    """
+    return values[-1] + steps * (values[-1] - values[-2])
+
+
+def extrapolate_hold(times, values, steps):
+    """Hold the last value"""
+    return np.full(len(steps), values[-1])
+
+
+ATM_EXTRAPOLATORS = {"linear": extrapolate_linear, "hold": extrapolate_hold}
+
+# How atm pressure is extended past a station's last observation, a key of `ATM_EXTRAPOLATORS`
+ATM_EXTRAPOLATION = os.environ.get("SDFP_EXTRAPOLATION", "linear").lower()
+if ATM_EXTRAPOLATION not in ATM_EXTRAPOLATORS:
+    warnings.warn(f"Unknown SDFP_EXTRAPOLATION {ATM_EXTRAPOLATION!r}; using linear")
+    ATM_EXTRAPOLATION = "linear"
+
+
+def extrapolate_atm_data(atm_data, until, method = "linear", max_gap = timedelta(seconds = 3600)):
+    """Extend atm pressure data that stops short of the sensor data by less than `max_gap`
+
+    New points continue at the timestep of the last two points until `until` is reached.
+    The number of steps, their times and their pressures are worked out at once rather
+    than one row at a time.
+
+    Args:
+        atm_data (pd.DataFrame): Atm pressure data sorted by date, with a 0..n-1 index
+        until (pd.Timestamp): Date the atm data must reach
+        method (str): Key into `ATM_EXTRAPOLATORS`
+        max_gap (timedelta): Gaps this long or longer are not extrapolated
+
+    Returns:
+        pd.DataFrame: `atm_data` with the extrapolated rows appended. Unchanged if no extrapolation applies
+    """
+    if atm_data.shape[0] < 2:  # (Must have at least 2 pressure values, otherwise skip it.)
+        return atm_data
+
+    t_last = atm_data["date"].iloc[-1]
+    if not (t_last < until and (until - t_last) < max_gap):
+        return atm_data
+
+    times = epoch_ns(atm_data["date"])
+    timestep = times[-1] - times[-2]
+    if timestep <= 0:
+        warnings.warn(message = f"Can't extrapolate atm pressure past duplicated timestamp {t_last}")
+        return atm_data
+
+    n = -(-(until.value - times[-1]) // timestep)
+    steps = np.arange(1, n + 1)
+
+    extrapolated = atm_data.iloc[[-1] * n].reset_index(drop = True)
+    extrapolated["date"] = pd.to_datetime(times[-1] + steps * timestep, utc = True)
+    extrapolated["pressure_mb"] = ATM_EXTRAPOLATORS[method](times, atm_data["pressure_mb"].to_numpy(dtype = float), steps)
+
+    print(f"Extrapolated {n} atm pressure value(s) past {t_last} ({method})")
+    if VERBOSITY >= 2:
+        print(extrapolated)
+
+    return pd.concat([atm_data, extrapolated], ignore_index = True)
+
+
+@timed("interpolate")
+def interpolate_atm_data(x, debug = True, store = None, extrapolation = "linear", health = None):
+    # Request each atmospheric station once for the union of the windows of the places that use it,
+    # hedging slow or empty primary sources with the places' backups
+    place_atm_data, atm_sources = fetch_atm_hedged(x, store = store, health = health)
+    
+    return interpolate_places(x, list(x["place"].unique()), place_atm_data, atm_sources, debug = debug, extrapolation = extrapolation)
+
+
+def interpolate_places(x, place_names, place_atm_data, atm_sources, place_positions = None, sensor_times = None, debug = True,
+                       extrapolation = "linear"):
+    """Interpolate the atm pressure of some places' measurements from their chosen sources
+
+    Args:
+        x (pd.DataFrame): Measurements matched to surveys
+        place_names (list): Places of `x` to interpolate, in output order
+        place_atm_data (dict): {place: pd.DataFrame}, each place's window of its chosen source
+        atm_sources (dict): {place: (role, atm_src, atm_id)}, from `resolve_atm_sources`
+        place_positions (dict, optional): Row positions of each place in `x`, when already computed
+        sensor_times (np.ndarray, optional): `epoch_ns` of `x["date"]`, when already computed
+        debug (bool): Print a summary per place
+        extrapolation (str): Key into `ATM_EXTRAPOLATORS`
+
+    Returns:
+        pd.DataFrame: The places' rows within their atm data's range, with `pressure_mb` and `processed`
+    """
+    if place_positions is None:
+        place_positions = x.groupby("place", observed = True, sort = False).indices
+    backup_places = [p for p in place_names if atm_sources[p][0] == "backup"]
+    
+    # Stage the sensor rows and atm series of every place, then interpolate them all in one pass
+    if sensor_times is None:
+        sensor_times = epoch_ns(x["date"])
+    
+    sample_positions, sample_groups, sample_processed = [], [], []
+    ref_groups, ref_times, ref_values = [], [], []
+    
+    for group, selected_place in enumerate(place_names):
+        print("for " + selected_place)
+        
+        positions = place_positions[selected_place]
+        selected_data = x.iloc[positions]
+        
+        dt_min = selected_data["date"].min() - timedelta(seconds = 1800)
+        dt_max = selected_data["date"].max() + timedelta(seconds = 1800)
+        dt_duration = dt_max - dt_min
+        
+        role, atm_src, atm_id = atm_sources[selected_place]
+        atm_data = place_atm_data.get(selected_place, pd.DataFrame())
             
-        if(selected_data["alt_atm_data_src"].unique()[0] and (atm_data.empty or atm_data['date'].max() < selected_data['date'].min()) ):
-            # Try backup source
-            print("Trying backup source for", selected_place)
-            print("  backup atm_src:", selected_data["alt_atm_data_src"].unique()[0])
-            atm_data = get_atm_pressure(atm_id = selected_data["alt_atm_station_id"].unique()[0], 
-                                atm_src = selected_data["alt_atm_data_src"].unique()[0], 
-                                begin_date = dt_min.strftime("%Y%m%d %H:%M"),
-                                end_date = dt_max.strftime("%Y%m%d %H:%M")).drop_duplicates() 
+        if role == "backup":
+            # Use backup source
+            print("Using backup source for", selected_place)
+            print("  backup atm_src:", atm_src)
             print("  backup atm rows:", atm_data.shape[0])
             
             if (atm_data.empty):
@@ -422,124 +1844,972 @@ def interpolate_atm_data(x, debug = True):
         #
 
         if not atm_data.empty:
-            atm_data = atm_data.sort_values("date").reset_index(drop=True).copy()
+            atm_data = atm_data.sort_values("date", ignore_index = True)
             t_last = atm_data.loc[atm_data.index[-1], "date"]
-            if atm_data["date"].max() < selected_data["date"].max() and (selected_data["date"].max() - atm_data["date"].max()) < timedelta(seconds = 3600):
-                if atm_data.shape[0] > 1:  # (Must have at least 2 pressure values, otherwise skip it.)
-                    print("ENTERED EXTRAPOLATION BLOCK")
-                    print("INITIAL ATM DATA")
-                    print(atm_data)
-                    while(atm_data["date"].max() < selected_data["date"].max() and (selected_data["date"].max() - atm_data["date"].max()) < timedelta(seconds = 3600)):
-                        # duplicate the last row
-                        last_row = atm_data.iloc[[-1]].copy()
-                        atm_data = pd.concat([atm_data, last_row], ignore_index=True)
-
-                        # set the time based on the timestep of the previous 2 points
-                        atm_data.loc[atm_data.index[-1], 'date'] = (
-                            atm_data.loc[atm_data.index[-2], 'date'] +
-                            (atm_data.loc[atm_data.index[-2], 'date'] - atm_data.loc[atm_data.index[-3], 'date'])
-                        )
-                        # set the value as a linear extrap of the previous 2 points
-                        atm_data.loc[atm_data.index[-1], 'pressure_mb'] = (
-                            float(atm_data.loc[atm_data.index[-2], 'pressure_mb']) +
-                            (float(atm_data.loc[atm_data.index[-2], 'pressure_mb']) - float(atm_data.loc[atm_data.index[-3], 'pressure_mb']))
-                        )
-
-                    print("APPENDED ATM DATA")
-                    print(atm_data)
-                    
-
-            combined_data = pd.concat([selected_data.query("date > @atm_data['date'].min() & date < @atm_data['date'].max()") , atm_data]).sort_values("date")
+            atm_data = extrapolate_atm_data(atm_data, until = selected_data["date"].max(), method = extrapolation)
+
+            atm_times = epoch_ns(atm_data["date"])
+            place_times = sensor_times[positions]
+            
+            # Only sensor rows inside the atm pressure date range can be interpolated
+            in_range = (place_times > atm_times.min()) & (place_times < atm_times.max())
+            in_range_positions = positions[in_range][np.argsort(place_times[in_range], kind = "stable")]
+            
+            sample_positions.append(in_range_positions)
+            sample_groups.append(np.full(len(in_range_positions), group))
             # Set the "processed" flag to true for those points that did not use extrapolated atm press values
-            combined_data["processed"] = combined_data["date"] <= t_last
-            combined_data = combined_data.set_index("date")
-            combined_data["pressure_mb"] = combined_data["pressure_mb"].astype(float).interpolate(method='time')
-                    
-            interpolated_data = pd.concat([interpolated_data, combined_data.loc[combined_data["place"].notna()].reset_index()[list(selected_data)]])
+            sample_processed.append(sensor_times[in_range_positions] <= t_last.value)
+            
+            ref_groups.append(np.full(len(atm_times), group))
+            ref_times.append(atm_times)
+            ref_values.append(atm_data["pressure_mb"].to_numpy(dtype = float))
 
             if debug == True:
                 print("####################################")
                 print(f"- New raw data detected for: {selected_place}")
                 print("- " , selected_data.shape[0] , " new rows")
                 print("- Date duration is: ", dt_duration.days, " days")
-                print("- " , selected_data.shape[0] - combined_data.loc[combined_data["place"].notna()].shape[0], "new observation(s) filtered out b/c not within atm pressure date range")
+                print("- " , selected_data.shape[0] - len(in_range_positions), "new observation(s) filtered out b/c not within atm pressure date range")
                 print("####################################")
     
+    if len(sample_positions) == 0:
+        return pd.DataFrame()
+    
+    sample_positions = np.concatenate(sample_positions)
+    sample_groups = np.concatenate(sample_groups)
+    
+    interpolated_data = x.take(sample_positions)
+    interpolated_data.index = pd.RangeIndex(interpolated_data.shape[0])
+    interpolated_data["pressure_mb"] = interpolate_groups(sample_groups = sample_groups,
+                                                          sample_times = sensor_times[sample_positions],
+                                                          ref_groups = np.concatenate(ref_groups),
+                                                          ref_times = np.concatenate(ref_times),
+                                                          ref_values = np.concatenate(ref_values))
+    interpolated_data["processed"] = np.concatenate(sample_processed)
+    
+    # Record the source each place actually used
+    for column, i in (("atm_data_src", 1), ("atm_station_id", 2)):
+        if isinstance(interpolated_data[column].dtype, pd.CategoricalDtype):
+            backup_values = {atm_sources[p][i] for p in backup_places}
+            new_categories = sorted(backup_values.difference(interpolated_data[column].cat.categories))
+            interpolated_data[column] = interpolated_data[column].cat.add_categories(new_categories)
+
+    for selected_place in backup_places:
+        rows = interpolated_data["place"] == selected_place
+        interpolated_data.loc[rows, "atm_data_src"] = atm_sources[selected_place][1]
+        interpolated_data.loc[rows, "atm_station_id"] = atm_sources[selected_place][2]
+    
     return interpolated_data
 
 
-def match_measurements_to_survey(measurements, surveys):
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
+@timed("match")
+def match_measurements_to_survey(measurements, surveys, verbosity = VERBOSITY):
+    """Attach to each measurement the most recent survey of its sensor taken at or before the measurement
+
+    Args:
+        measurements (pd.DataFrame): Raw rows from `sensor_data`
+        surveys (pd.DataFrame): Rows from `sensor_surveys`
+        verbosity (int): 2 or more prints the full measurement, survey and matched frames
+
+    Returns:
+        pd.DataFrame: Measurements of surveyed sensors with their survey columns
+    """
 
     sites = measurements["sensor_ID"].unique()
     survey_sites = surveys["sensor_ID"].unique()
-    
-    matching_sites = list(set(sites) & set(survey_sites))
-    missing_sites = list(set(sites).difference(survey_sites))
-    
+
+    missing_sites = sorted(set(sites).difference(survey_sites))
+
     if len(missing_sites) > 0:
-        warnings.warn(message = str("Missing survey data for: " + ''.join(missing_sites) + ". The site(s) will not be processed."))    
-    
-    matched_measurements = pd.DataFrame()
-    
-    for selected_site in matching_sites:
-        print(selected_site)
-        
-        selected_measurements = measurements.query("sensor_ID == @selected_site").copy()
+        warnings.warn(message = str("Missing survey data for: " + ', '.join(missing_sites) + ". The site(s) will not be processed."))
+
+    selected_measurements = measurements.loc[measurements["sensor_ID"].isin(survey_sites)] if len(missing_sites) > 0 else measurements
+    if verbosity >= 2:
         print(selected_measurements.to_string())    # FOR DEBUGGING
-        
-        selected_survey = surveys.query("sensor_ID == @selected_site")
         print()
-        print("selected_survey")
-        print(selected_survey.to_string())  # FOR DEBUGGING
-        
-        if selected_survey.empty:
-            warnings.warn("There are no survey data for: " + selected_site)
-        
-        survey_dates = list(selected_survey["date_surveyed"].unique())
-        number_of_surveys = len(survey_dates)
-        
-        if measurements["date"].min() < min(survey_dates):
-            warnings.warn("Warning: There are data that precede the survey dates for: " + selected_site)
-            
-        if number_of_surveys == 1:
-            selected_measurements["date_surveyed"] = pd.to_datetime(np.where(selected_measurements["date"] >= survey_dates[0], survey_dates[0], np.nan), utc = True)
-            
-        if number_of_surveys > 1:
-            survey_dates.append(pd.to_datetime(datetime.utcnow(), utc=True))
-            selected_measurements["date_surveyed"] = pd.to_datetime(pd.cut(selected_measurements["date"], bins = survey_dates, labels = survey_dates[:-1]), utc = True).astype('datetime64[ns, UTC]')
+        print("surveys")
+        print(surveys.to_string())  # FOR DEBUGGING
+
+    # One row per survey, with the survey's notes left out so they don't collide with the measurements'.
+    # Repeated surveys would otherwise repeat every measurement they match
+    surveys = compact_dtypes(surveys.drop(columns = ["notes"], errors = "ignore")
+                                    .assign(date_surveyed = pd.to_datetime(surveys["date_surveyed"], utc = True))
+                                    .drop_duplicates(subset = ["place", "sensor_ID", "date_surveyed"]))
+
+    # Pick, for every measurement, the latest survey of its sensor on or before the measurement date.
+    # Only the keys are sorted for the match, not the measurements themselves
+    survey_dates = surveys.loc[:, ["sensor_ID", "date_surveyed"]].drop_duplicates().sort_values("date_surveyed")
+    survey_dates["sensor_ID"] = survey_dates["sensor_ID"].astype(object)
+
+    measurement_dates = pd.DataFrame({"sensor_ID": selected_measurements["sensor_ID"].astype(object).to_numpy(),
+                                      "_date_utc": pd.to_datetime(selected_measurements["date"], utc = True).array,
+                                      "_row": np.arange(selected_measurements.shape[0])}).sort_values("_date_utc")
+
+    measurement_dates = pd.merge_asof(measurement_dates, survey_dates, left_on = "_date_utc", right_on = "date_surveyed",
+                                      by = "sensor_ID", direction = "backward").sort_values("_row")
+
+    preceding_sites = sorted(measurement_dates.loc[measurement_dates["date_surveyed"].isna(), "sensor_ID"].unique())
+    if len(preceding_sites) > 0:
+        warnings.warn("Warning: There are data that precede the survey dates for: " + ', '.join(preceding_sites))
+
+    matched_measurements = pd.merge(selected_measurements.assign(date_surveyed = measurement_dates["date_surveyed"].array),
+                                    surveys, how = "left", on = ["place","sensor_ID","date_surveyed"])
+    matched_measurements = matched_measurements.sort_values(["place", "date"], kind = "stable", ignore_index = True)
     
-        merged_measurements_and_surveys = pd.merge(selected_measurements, surveys, how = "left", on = ["place","sensor_ID","date_surveyed"])
+    if verbosity >= 2:
         print()
-        print("merged_measurements_and_surveys")
-        print(merged_measurements_and_surveys.to_string())  # FOR DEBUGGING
+        print("matched_measurements")
+        print(matched_measurements.to_string())  # FOR DEBUGGING
+    print("matched_measurements.shape: ", matched_measurements.shape)
+        
+    return matched_measurements
+
+
+@timed("format")
+def format_interpolated_data(x):
+    """Build the `sensor_water_depth` rows of the interpolated data
+
+    The output columns are taken straight from `x` rather than copying it whole and trimming the copy.
+    A (place, sensor_ID, date) key that occurs more than once is only kept the first time.
+
+    Args:
+        x (pd.DataFrame): Output of `interpolate_atm_data`
+
+    Returns:
+        pd.DataFrame: `sensor_water_depth` columns and `processed`, indexed by `place`, `sensor_ID` and `date`
+    """
+    formatted_data = pd.DataFrame({
+        "place": x["place"], "sensor_ID": x["sensor_ID"], "date": x["date"],
+        "atm_pressure": x["pressure_mb"], "sensor_pressure": x["pressure"], "voltage": x["voltage"], "notes": x["notes"],
+        "sensor_water_depth": ((((x["pressure"] - x["pressure_mb"]) * 100) / (1020 * 9.81)) * 3.28084),
+        "qa_qc_flag": False, "tag": pd.Categorical.from_codes(np.zeros(x.shape[0], dtype = np.int8), ["new_data"]),
+        "atm_data_src": x["atm_data_src"], "atm_station_id": x["atm_station_id"], "processed": x["processed"]})
+
+    formatted_data.set_index(['place', 'sensor_ID', 'date'], inplace=True)
+
+    # Duplicates are judged by key alone: identical values at two different keys are two rows to write,
+    # and two rows at one key can't both be upserted
+    if formatted_data.index.has_duplicates:
+        formatted_data = formatted_data.loc[~formatted_data.index.duplicated()]
+
+    return formatted_data
+
+
+#####################
+# Ingestion         #
+#####################
+
+# Columns of `sensor_data` the pipeline uses
+SENSOR_DATA_COLUMNS = ["place", "sensor_ID", "date", "pressure", "voltage", "notes", "processed"]
+
+# Identifier and text columns are held as categoricals: a few bytes per row instead of a Python string each.
+# Numeric columns that are never written back are held as float32; pressures and voltages are written to
+# `double precision` columns and stay float64 so the stored values don't change
+CATEGORICAL_COLUMNS = ["place", "sensor_ID", "notes", "atm_station_id", "atm_data_src", "alt_atm_station_id", "alt_atm_data_src"]
+FLOAT32_COLUMNS = ["sensor_elevation"]
+
+# Rows fetched from the server per chunk while reading raw data
+READ_CHUNKSIZE = int(os.environ.get("SDFP_READ_CHUNKSIZE", 100000))
+
+# Largest working set a batch of raw data may need, in MB. 0 processes everything in one batch
+MEMORY_BUDGET_MB = float(os.environ.get("SDFP_MEMORY_BUDGET_MB", 1024))
+
+# `on` streams places through atm requests, interpolation, formatting and writing as their atm data
+# arrives, and reads `sensor_surveys` alongside the raw data (see `process_batch_pipelined`)
+PIPELINE = os.environ.get("SDFP_PIPELINE", "off").lower() not in ("off", "false", "0", "none")
+
+# Peak memory of matching, interpolating and formatting a batch per byte of its compact raw data
+# (about 8.6 on synthetic data from benchmark.py), with room for one write chunk
+PIPELINE_MEMORY_FACTOR = 10
+
+# Unprocessed rows this far behind a sensor's watermark are still read, to catch late uploads
+WATERMARK_LOOKBACK = timedelta(hours = float(os.environ.get("SDFP_WATERMARK_LOOKBACK_HOURS", 6)))
+
+CHECKPOINT_DDL = """CREATE TABLE IF NOT EXISTS sensor_processing_checkpoint (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    last_processed timestamptz,
+    pending_since timestamptz,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (place, "sensor_ID")
+)"""
+
+# Rows whose water depth was written with extrapolated atm pressure, and the station it came from.
+# `recorrect_extrapolated_rows` replaces their atm pressure once the station has real observations
+EXTRAPOLATED_ROWS_DDL = """CREATE TABLE IF NOT EXISTS atm_extrapolated_rows (
+    place text NOT NULL,
+    "sensor_ID" text NOT NULL,
+    date timestamptz NOT NULL,
+    atm_data_src text NOT NULL,
+    atm_station_id text NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (place, "sensor_ID", date)
+)"""
+
+# Recommended indexes for the ingestion query. The partial index covers it without touching the heap
+RECOMMENDED_INDEXES = [
+    """CREATE INDEX IF NOT EXISTS sensor_data_unprocessed_idx ON sensor_data ("sensor_ID", date)
+       INCLUDE (place, pressure, voltage, notes) WHERE processed = FALSE""",
+    # Neighbouring FIMAN pressure rows for `process_fiman_in_database`
+    """CREATE INDEX IF NOT EXISTS api_data_fiman_pressure_idx ON api_data (id, date)
+       INCLUDE (value) WHERE api_name = 'FIMAN' AND type = 'pressure'""",
+]
+
+
+def ensure_checkpoint_table(engine):
+    """Create `sensor_processing_checkpoint` if it doesn't exist, and the recommended indexes if `SDFP_CREATE_INDEXES` is set
+
+    Returns:
+        bool: True if the checkpoint table is usable
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(CHECKPOINT_DDL))
+    except Exception as ex:
+        warnings.warn("Checkpoint table unavailable; scanning all unprocessed data instead")
+        print(f"ensure_checkpoint_table error: {type(ex).__name__}: {ex}")
+        return False
+
+    if os.environ.get("SDFP_CREATE_INDEXES", "").lower() in ("1", "true", "yes"):
+        for ddl in RECOMMENDED_INDEXES:
+            print(ddl)
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+
+    return True
+
+
+def ensure_recorrection_table(engine):
+    """Create `atm_extrapolated_rows` unless re-correction is disabled with `SDFP_RECORRECTION=off`
+
+    Re-correction updates rows in place, so it is also off with the `safe_insert` write method.
+
+    Returns:
+        bool: True if extrapolated rows are tracked and re-corrected. Otherwise they are left
+            unprocessed and reprocessed by later runs like any other pending row
+    """
+    if os.environ.get("SDFP_RECORRECTION", "on").lower() in ("off", "false", "0", "none") or WRITE_METHOD == "safe_insert":
+        return False
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(EXTRAPOLATED_ROWS_DDL))
+    except Exception as ex:
+        warnings.warn("Extrapolated rows table unavailable; reprocessing extrapolated rows with the new data instead")
+        print(f"ensure_recorrection_table error: {type(ex).__name__}: {ex}")
+        return False
+
+    return True
+
+
+def compact_dtypes(df):
+    """Convert the `CATEGORICAL_COLUMNS` and `FLOAT32_COLUMNS` of `df` in place
+
+    Returns:
+        pd.DataFrame: `df`
+    """
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype("category")
+    for col in FLOAT32_COLUMNS:
+        if col in df.columns and df[col].dtype == np.float64:
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+def concat_compact(chunks):
+    """Concatenate compacted chunks, merging the categories of each categorical column so it stays categorical"""
+    if len(chunks) == 1:
+        return chunks[0]
+
+    for col in chunks[0].columns:
+        if all(isinstance(chunk[col].dtype, pd.CategoricalDtype) for chunk in chunks):
+            categories = union_categoricals([chunk[col] for chunk in chunks], sort_categories = True).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+
+    return compact_dtypes(pd.concat(chunks, ignore_index = True))
+
+
+def read_compact(query, engine, params, chunksize = READ_CHUNKSIZE):
+    """Read a query through a server-side cursor, compacting each chunk as it arrives
+
+    Only one chunk is ever held as Python objects, so a large backlog doesn't need the
+    memory of its object-dtype frame on top of the compact one.
+
+    Returns:
+        pd.DataFrame: Result of the query, sorted by place and date, without duplicate rows
+    """
+    with engine.connect().execution_options(stream_results = True) as conn:
+        chunks = [compact_dtypes(chunk) for chunk in pd.read_sql_query(query, conn, params = params, chunksize = chunksize)]
+
+    data = concat_compact(chunks).sort_values(['place','date'], ignore_index = True)
+    duplicated = data.duplicated()
+    return data.loc[~duplicated].reset_index(drop = True) if duplicated.any() else data
+
+
+def batch_places(new_data, budget_mb = MEMORY_BUDGET_MB):
+    """Split the places of `new_data` into batches whose working set fits in `budget_mb`
+
+    The working set of a batch is estimated from the compact size of its raw rows times
+    `PIPELINE_MEMORY_FACTOR`. Places are never split, so a place too big for the budget
+    gets a batch of its own.
+
+    Args:
+        new_data (pd.DataFrame): Output of `read_new_sensor_data`
+        budget_mb (float): Memory budget in MB. 0 puts every place in one batch
+
+    Returns:
+        list: Lists of place names, in order of the places in `new_data`
+    """
+    sizes = new_data.groupby("place", observed = True, sort = False).size()
+
+    if not budget_mb or new_data.shape[0] == 0:
+        return [list(sizes.index)]
+
+    row_bytes = new_data.memory_usage(deep = True).sum() / new_data.shape[0] * PIPELINE_MEMORY_FACTOR
+    max_rows = max(1, int(budget_mb * 2**20 / row_bytes))
+
+    batches, batch, batch_rows = [], [], 0
+    for place, rows in sizes.items():
+        if batch and batch_rows + rows > max_rows:
+            batches.append(batch)
+            batch, batch_rows = [], 0
+        batch.append(place)
+        batch_rows += rows
+    batches.append(batch)
+
+    return batches
+
+
+@timed("read", table = "sensor_data")
+def read_new_sensor_data(engine, start_date, use_checkpoints = True, skip_tracked = False, places = None):
+    """Read the raw rows that still need processing
+
+    With checkpoints, only rows past each sensor's watermark (less `WATERMARK_LOOKBACK`) or at or
+    after its oldest pending row are read. Sensors without a checkpoint are read back to `start_date`.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        start_date (datetime): Oldest date to read, UTC
+        use_checkpoints (bool): Filter by `sensor_processing_checkpoint`
+        skip_tracked (bool): Leave out rows in `atm_extrapolated_rows`, which `recorrect_extrapolated_rows` takes care of
+        places (list, optional): Only read these places
+
+    Returns:
+        pd.DataFrame: `SENSOR_DATA_COLUMNS` of the rows to process with compact dtypes, sorted by place and date
+    """
+    columns = ", ".join("d." + quote_ident(c) for c in SENSOR_DATA_COLUMNS)
+    tracked_filter = ("""AND NOT EXISTS (SELECT 1 FROM atm_extrapolated_rows e
+                                          WHERE e.place = d.place AND e."sensor_ID" = d."sensor_ID" AND e.date = d.date)"""
+                      if skip_tracked else "")
+    place_filter = "AND d.place = ANY(:places)" if places is not None else ""
+
+    if use_checkpoints:
+        query = text(f"""SELECT {columns} FROM sensor_data d
+                         LEFT JOIN sensor_processing_checkpoint c ON c.place = d.place AND c."sensor_ID" = d."sensor_ID"
+                         WHERE d.processed = FALSE AND d.pressure > 800 AND d.date >= :start_date
+                         AND (c.last_processed IS NULL OR d.date > c.last_processed - :lookback OR d.date >= c.pending_since)
+                         {tracked_filter} {place_filter}""")
+        params = {"start_date": start_date, "lookback": WATERMARK_LOOKBACK}
+    else:
+        query = text(f"SELECT {columns} FROM sensor_data d WHERE d.processed = FALSE AND d.pressure > 800 AND d.date >= :start_date {tracked_filter} {place_filter}")
+        params = {"start_date": start_date}
+
+    if places is not None:
+        params["places"] = list(places)
+
+    print(query)
+    print(params)
+    return read_compact(query, engine, params)
+
+
+def compute_checkpoints(new_data, processed_keys, tracked_keys = None):
+    """Per-sensor watermark after a run
+
+    `last_processed` is the latest row flagged as processed. `pending_since` is the oldest row
+    after it that was read but not flagged (extrapolated, or beyond the atm data), so it is read
+    again next run. Unflagged rows before the watermark are left to a backfill. Extrapolated rows
+    tracked for re-correction are not pending.
+
+    Args:
+        new_data (pd.DataFrame): Rows read this run
+        processed_keys (pd.DataFrame): `place`, `sensor_ID`, `date` of the rows flagged as processed
+        tracked_keys (pd.DataFrame, optional): `place`, `sensor_ID`, `date` of the rows added to `atm_extrapolated_rows`
+
+    Returns:
+        pd.DataFrame: `place`, `sensor_ID`, `last_processed`, `pending_since`
+    """
+    keys = ["place", "sensor_ID"]
+
+    last_processed = processed_keys.groupby(keys, observed = True)["date"].max().rename("last_processed")
+    checkpoints = new_data.loc[:, keys + ["date"]].merge(last_processed.reset_index(), on = keys, how = "left")
+
+    handled_keys = processed_keys.loc[:, keys + ["date"]]
+    if tracked_keys is not None:
+        handled_keys = pd.concat([handled_keys, tracked_keys.loc[:, keys + ["date"]]], ignore_index = True)
+
+    flagged = checkpoints.merge(handled_keys.drop_duplicates().assign(_flagged = True),
+                                on = keys + ["date"], how = "left")["_flagged"].fillna(False).to_numpy(dtype = bool)
+    pending = ~flagged & (checkpoints["last_processed"].isna() | (checkpoints["date"] > checkpoints["last_processed"])).to_numpy()
+
+    pending_since = checkpoints.loc[pending].groupby(keys, observed = True)["date"].min().rename("pending_since")
+
+    return checkpoints.groupby(keys, observed = True)["last_processed"].first().to_frame().join(pending_since).reset_index()
+
+
+@timed("write", table = "sensor_processing_checkpoint")
+def update_checkpoints(conn, checkpoints):
+    """Upsert per-sensor checkpoints. The watermark never moves backwards
+
+    Args:
+        conn (sqlalchemy.engine.Connection): Connection inside the transaction that wrote the results
+        checkpoints (pd.DataFrame): Output of `compute_checkpoints`
+    """
+    if checkpoints.empty:
+        return
+
+    rows = [{"place": r.place, "sensor_ID": r.sensor_ID,
+             "last_processed": None if pd.isna(r.last_processed) else r.last_processed.to_pydatetime(),
+             "pending_since": None if pd.isna(r.pending_since) else r.pending_since.to_pydatetime()}
+            for r in checkpoints.itertuples(index = False)]
+
+    conn.execute(text("""INSERT INTO sensor_processing_checkpoint (place, "sensor_ID", last_processed, pending_since, updated_at)
+                         VALUES (:place, :sensor_ID, :last_processed, :pending_since, now())
+                         ON CONFLICT (place, "sensor_ID") DO UPDATE SET
+                             last_processed = GREATEST(sensor_processing_checkpoint.last_processed, EXCLUDED.last_processed),
+                             pending_since = EXCLUDED.pending_since,
+                             updated_at = now()"""), rows)
+
+
+# `fiman` processes places whose atm pressure comes from FIMAN inside Postgres (see `process_fiman_in_database`)
+SQL_ENGINE = os.environ.get("SDFP_SQL_ENGINE", "off").lower()
+
+# How far past a place's rows the pandas path reads FIMAN pressure: the half hour either side of the
+# place's window (`plan_atm_fetches`) plus the hour `get_fiman_atm_batch` pads requests with
+FIMAN_WINDOW_MARGIN = timedelta(seconds = 1800 + 3600)
+
+
+def process_fiman_in_database(engine, start_date, use_checkpoints = True, places = None):
+    """Compute and write the water depths of FIMAN-sourced rows in one server-side statement
+
+    The rows are the ones `read_new_sensor_data` would read. Each is matched to its sensor's
+    latest survey like `match_measurements_to_survey` does. If that survey's atm source is FIMAN,
+    the atm pressure is interpolated in time between the neighbouring `api_data` rows, found with
+    LATERAL joins within the window the pandas path would request for the place (its rows, widened
+    by `FIMAN_WINDOW_MARGIN`), so no gap is bridged that the pandas path wouldn't bridge. As in
+    `interpolate_atm_data`, a row needs an observation before it in that window. The depth is computed with the formula of `format_interpolated_data`, upserted
+    into `sensor_water_depth`, and the raw row is flagged as processed.
+
+    Rows that don't have FIMAN pressure on both sides (normally the latest few minutes, which need
+    extrapolation), or that use another source, are left for the pandas path in the same run. Their
+    sensors' checkpoints are moved back to them so that path still reads them.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        start_date (datetime): Oldest date to read, UTC
+        use_checkpoints (bool): Filter by, and update, `sensor_processing_checkpoint`
+        places (list, optional): Only process these places
+
+    Returns:
+        int: Number of rows processed
+    """
+    if use_checkpoints:
+        checkpoint_join = 'LEFT JOIN sensor_processing_checkpoint c ON c.place = d.place AND c."sensor_ID" = d."sensor_ID"'
+        checkpoint_filter = "AND (c.last_processed IS NULL OR d.date > c.last_processed - :lookback OR d.date >= c.pending_since)"
+        # Unflagged rows before the new watermark become pending, so the pandas path still reads them
+        checkpoint_update = """,
+            pending AS (
+                SELECT b.place, b."sensor_ID", min(b.date) AS pending_since FROM base b
+                WHERE NOT EXISTS (SELECT 1 FROM written w WHERE w.place = b.place AND w."sensor_ID" = b."sensor_ID" AND w.date = b.date)
+                GROUP BY b.place, b."sensor_ID"),
+            checkpoints AS (
+                INSERT INTO sensor_processing_checkpoint (place, "sensor_ID", last_processed, pending_since, updated_at)
+                SELECT f.place, f."sensor_ID", f.last_processed,
+                       CASE WHEN p.pending_since < f.last_processed THEN p.pending_since END, now()
+                FROM (SELECT place, "sensor_ID", max(date) AS last_processed FROM flagged GROUP BY place, "sensor_ID") f
+                LEFT JOIN pending p ON p.place = f.place AND p."sensor_ID" = f."sensor_ID"
+                ON CONFLICT (place, "sensor_ID") DO UPDATE SET
+                    last_processed = GREATEST(sensor_processing_checkpoint.last_processed, EXCLUDED.last_processed),
+                    pending_since = EXCLUDED.pending_since,
+                    updated_at = now())"""
+    else:
+        checkpoint_join = checkpoint_filter = checkpoint_update = ""
+
+    place_filter = "AND d.place = ANY(:places)" if places is not None else ""
+
+    depth_columns = ["atm_pressure", "sensor_pressure", "voltage", "notes", "sensor_water_depth", "qa_qc_flag", "tag", "atm_data_src", "atm_station_id"]
+    if WRITE_METHOD == "safe_insert":
+        on_conflict = "ON CONFLICT ON CONSTRAINT sensor_water_depth_pkey DO NOTHING"
+    else:
+        on_conflict = ("ON CONFLICT ON CONSTRAINT sensor_water_depth_pkey DO UPDATE SET "
+                       + ", ".join(f"{quote_ident(c)} = EXCLUDED.{quote_ident(c)}" for c in depth_columns))
+
+    query = text(f"""
+        WITH base AS (
+            SELECT d.place, d."sensor_ID", d.date, d.pressure, d.voltage, d.notes, s.place AS survey_place, s.atm_station_id, s.atm_data_src
+            FROM sensor_data d
+            {checkpoint_join}
+            LEFT JOIN LATERAL (
+                SELECT s.place, s.atm_station_id, s.atm_data_src FROM sensor_surveys s
+                WHERE s."sensor_ID" = d."sensor_ID" AND s.date_surveyed <= d.date
+                ORDER BY s.date_surveyed DESC LIMIT 1) s ON TRUE
+            WHERE d.processed = FALSE AND d.pressure > 800 AND d.date >= :start_date
+            {checkpoint_filter} {place_filter}),
+        fiman AS (
+            SELECT b.*, min(b.date) OVER place_rows - :window_margin AS window_begin, max(b.date) OVER place_rows + :window_margin AS window_end
+            FROM base b
+            WHERE b.survey_place = b.place AND upper(b.atm_data_src) = 'FIMAN'
+            WINDOW place_rows AS (PARTITION BY b.place)),
+        interpolated AS (
+            SELECT b.place, b."sensor_ID", b.date, b.pressure, b.voltage, b.notes, b.atm_data_src, b.atm_station_id,
+                   CASE WHEN nxt.date = b.date THEN nxt.value
+                        ELSE prev.value + (nxt.value - prev.value) * extract(epoch FROM b.date - prev.date) / extract(epoch FROM nxt.date - prev.date)
+                   END AS atm_pressure
+            FROM fiman b
+            CROSS JOIN LATERAL (
+                SELECT a.date, a.value FROM api_data a
+                WHERE a.id = b.atm_station_id AND a.api_name = 'FIMAN' AND a.type = 'pressure' AND a.value IS NOT NULL
+                  AND a.date < b.date AND a.date >= b.window_begin
+                ORDER BY a.date DESC LIMIT 1) prev
+            CROSS JOIN LATERAL (
+                SELECT a.date, a.value FROM api_data a
+                WHERE a.id = b.atm_station_id AND a.api_name = 'FIMAN' AND a.type = 'pressure' AND a.value IS NOT NULL
+                  AND a.date >= b.date AND a.date <= b.window_end
+                ORDER BY a.date LIMIT 1) nxt
+            -- Like the pandas path, a row on the window's last observation needs a later row of its place to extrapolate to
+            WHERE nxt.date > b.date OR b.date < b.window_end - :window_margin),
+        written AS (
+            INSERT INTO sensor_water_depth (place, "sensor_ID", date, {", ".join(quote_ident(c) for c in depth_columns)})
+            SELECT place, "sensor_ID", date, atm_pressure, pressure, voltage, notes,
+                   (((pressure - atm_pressure) * 100) / (1020 * 9.81)) * 3.28084, FALSE, 'new_data', atm_data_src, atm_station_id
+            FROM interpolated
+            {on_conflict}
+            RETURNING place, "sensor_ID", date),
+        flagged AS (
+            UPDATE sensor_data d SET processed = TRUE FROM written w
+            WHERE d.place = w.place AND d."sensor_ID" = w."sensor_ID" AND d.date = w.date
+            RETURNING d.place, d."sensor_ID", d.date){checkpoint_update}
+        SELECT count(*) FROM flagged""")
+    params = {"start_date": start_date, "lookback": WATERMARK_LOOKBACK, "window_margin": FIMAN_WINDOW_MARGIN,
+              "places": list(places) if places is not None else None}
+
+    print(query)
+    with metrics.span("sql_engine", source = "FIMAN") as record:
+        with engine.begin() as conn:
+            processed = conn.execute(query, params).scalar()
+        record["rows"] = processed
+
+    print(f"Processed {processed} FIMAN row(s) in the database")
+    return processed
+
+
+@timed("write", table = "atm_extrapolated_rows")
+def track_extrapolated_rows(conn, rows):
+    """Add rows written with extrapolated atm pressure to `atm_extrapolated_rows`
+
+    Args:
+        conn (sqlalchemy.engine.Connection): Connection inside the transaction that wrote the rows
+        rows (pd.DataFrame): `place`, `sensor_ID`, `date`, `atm_data_src` and `atm_station_id` of the rows
+    """
+    if rows.empty:
+        return
+
+    columns = ["place", "sensor_ID", "date", "atm_data_src", "atm_station_id"]
+    column_list = ", ".join(quote_ident(c) for c in columns)
+
+    cursor = conn.connection.cursor()
+    try:
+        staging = copy_to_staging(cursor, "atm_extrapolated_rows", columns, rows.loc[:, columns].itertuples(index = False, name = None))
+        cursor.execute(f"""INSERT INTO atm_extrapolated_rows ({column_list}) SELECT {column_list} FROM {staging}
+                           ON CONFLICT (place, "sensor_ID", date) DO UPDATE SET
+                               atm_data_src = EXCLUDED.atm_data_src, atm_station_id = EXCLUDED.atm_station_id""")
+        cursor.execute(f"DROP TABLE {staging}")
+    finally:
+        cursor.close()
+
+
+@timed("recorrect")
+def recorrect_extrapolated_rows(engine, start_date, store = None, health = None, max_gap = timedelta(seconds = 3600), places = None,
+                                extrapolation = "linear"):
+    """Replace the extrapolated atm pressure of tracked rows once their stations have real observations
+
+    Each station is only requested around its tracked rows. A row is never extrapolated more than
+    `max_gap` past the station's last observation, so the observation before it is at most that far
+    back, and the one after it is looked for up to `max_gap` after the station's latest row. Rows
+    that now lie between two observations get `atm_pressure` and `sensor_water_depth` updated in
+    place, are flagged as processed and are no longer tracked. The others stay tracked; those still
+    within `max_gap` past the station's latest observation get their estimate updated by
+    extrapolating from the newer observations.
+
+    Tracked rows that were processed some other way (by a backfill, say), or that are older than
+    `start_date`, are dropped first.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        start_date (datetime): Oldest date still tracked, UTC
+        store (AtmPressureStore, optional): Persistent store passed on to `get_atm_pressure`
+        health (StationHealth, optional): Station health records. Stations with an open circuit are skipped
+        max_gap (timedelta): Longest extrapolation, as in `extrapolate_atm_data`
+        places (list, optional): Only re-correct rows of these places
+        extrapolation (str): Key into `ATM_EXTRAPOLATORS`, for the rows that are still extrapolated
+
+    Returns:
+        pd.DataFrame: `place`, `sensor_ID`, `date`, `atm_data_src`, `atm_station_id` and the new `atm_pressure` of the re-corrected rows
+    """
+    place_filter = "AND e.place = ANY(:places)" if places is not None else ""
+    params = {"start_date": start_date, "places": list(places) if places is not None else None}
+
+    with engine.begin() as conn:
+        conn.execute(text(f"""DELETE FROM atm_extrapolated_rows e WHERE (e.date < :start_date OR NOT EXISTS (
+                                  SELECT 1 FROM sensor_data d
+                                  WHERE d.place = e.place AND d."sensor_ID" = e."sensor_ID" AND d.date = e.date AND d.processed = FALSE))
+                              {place_filter}"""), params)
+        tracked = pd.read_sql_query(text(f'SELECT place, "sensor_ID", date, atm_data_src, atm_station_id FROM atm_extrapolated_rows e '
+                                         f'WHERE TRUE {place_filter}'), conn, params = params)
+
+    if tracked.shape[0] == 0:
+        return tracked.assign(atm_pressure = np.nan)
+
+    tracked["atm_data_src"] = tracked["atm_data_src"].str.upper()
+    station_positions = tracked.groupby(["atm_data_src", "atm_station_id"], sort = False).indices
+
+    plan = {}
+    for key, positions in station_positions.items():
+        if health is not None and health.is_open(key):
+            continue
+        dates = tracked["date"].iloc[positions]
+        plan[key] = {"atm_id": key[1], "atm_src": key[0], "begin": dates.min() - max_gap, "end": dates.max() + max_gap,
+                     "places": list(tracked["place"].iloc[positions].unique())}
+
+    atm_cache = fetch_atm_plan(plan, store = store, health = health)
+    if health is not None:
+        health.save()
+
+    # Interpolate the rows of every station in one pass, against its real observations only
+    row_times = epoch_ns(tracked["date"])
+    sample_positions, sample_groups = [], []
+    ref_groups, ref_times, ref_values = [], [], []
+    ahead_positions, ahead_groups = [], []
+    ahead_ref_groups, ahead_ref_times, ahead_ref_values = [], [], []
+
+    for group, key in enumerate(plan):
+        atm_data = atm_cache.get(key, pd.DataFrame())
+        if atm_data.empty:
+            continue
+
+        atm_values = pd.to_numeric(atm_data["pressure_mb"], errors = "coerce").to_numpy(dtype = float)
+        atm_times = epoch_ns(atm_data["date"])[~np.isnan(atm_values)]
+        if len(atm_times) == 0:
+            continue
+
+        positions = station_positions[key]
+        times = row_times[positions]
+        ahead = positions[(times > atm_times.max()) & (times - atm_times.max() < max_gap.total_seconds() * 1e9)]
+        positions = positions[(times > atm_times.min()) & (times <= atm_times.max())]
+
+        sample_positions.append(positions)
+        sample_groups.append(np.full(len(positions), group))
+        ref_groups.append(np.full(len(atm_times), group))
+        ref_times.append(atm_times)
+        ref_values.append(atm_values[~np.isnan(atm_values)])
+
+        if len(ahead) > 0:
+            series = pd.DataFrame({"date": pd.to_datetime(atm_times, utc = True), "pressure_mb": atm_values[~np.isnan(atm_values)]})
+            series = extrapolate_atm_data(series.sort_values("date", ignore_index = True), until = tracked["date"].iloc[ahead].max(),
+                                          method = extrapolation, max_gap = max_gap)
+            ahead_positions.append(ahead)
+            ahead_groups.append(np.full(len(ahead), group))
+            ahead_ref_groups.append(np.full(series.shape[0], group))
+            ahead_ref_times.append(epoch_ns(series["date"]))
+            ahead_ref_values.append(series["pressure_mb"].to_numpy(dtype = float))
+
+    # Rows still past their station's last observation get a fresher estimate, and stay tracked
+    ahead = tracked.iloc[:0].assign(atm_pressure = np.nan)
+    if len(ahead_positions) > 0:
+        ahead_positions = np.concatenate(ahead_positions)
+        ahead = tracked.take(ahead_positions)
+        ahead["atm_pressure"] = interpolate_groups(sample_groups = np.concatenate(ahead_groups),
+                                                   sample_times = row_times[ahead_positions],
+                                                   ref_groups = np.concatenate(ahead_ref_groups),
+                                                   ref_times = np.concatenate(ahead_ref_times),
+                                                   ref_values = np.concatenate(ahead_ref_values))
+        ahead = ahead.loc[ahead["atm_pressure"].notna()]
+        update_extrapolated_depths(engine, ahead)
+
+    if len(sample_positions) == 0 or sum(len(p) for p in sample_positions) == 0:
+        print(f"{tracked.shape[0]} extrapolated row(s) tracked, none re-corrected, {ahead.shape[0]} re-extrapolated")
+        return tracked.iloc[:0].assign(atm_pressure = np.nan)
+
+    sample_positions = np.concatenate(sample_positions)
+    corrected = tracked.take(sample_positions)
+    corrected["atm_pressure"] = interpolate_groups(sample_groups = np.concatenate(sample_groups),
+                                                   sample_times = row_times[sample_positions],
+                                                   ref_groups = np.concatenate(ref_groups),
+                                                   ref_times = np.concatenate(ref_times),
+                                                   ref_values = np.concatenate(ref_values))
+    corrected = corrected.loc[corrected["atm_pressure"].notna()]
+
+    # Update the depths in place from their stored sensor pressure (with the formula of `format_interpolated_data`),
+    # flag the raw rows and stop tracking them, in one statement
+    columns = ["place", "sensor_ID", "date", "atm_pressure"]
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        try:
+            staging = copy_to_staging(cursor, "sensor_water_depth", columns, corrected.loc[:, columns].itertuples(index = False, name = None))
+            cursor.execute(f"""
+                WITH updated AS (
+                    UPDATE sensor_water_depth w SET atm_pressure = s.atm_pressure,
+                        sensor_water_depth = (((w.sensor_pressure - s.atm_pressure) * 100) / (1020 * 9.81)) * 3.28084
+                    FROM {staging} s
+                    WHERE w.place = s.place AND w."sensor_ID" = s."sensor_ID" AND w.date = s.date
+                    RETURNING w.place, w."sensor_ID", w.date),
+                flagged AS (
+                    UPDATE sensor_data d SET processed = TRUE FROM updated u
+                    WHERE d.place = u.place AND d."sensor_ID" = u."sensor_ID" AND d.date = u.date),
+                untracked AS (
+                    DELETE FROM atm_extrapolated_rows e USING {staging} s
+                    WHERE e.place = s.place AND e."sensor_ID" = s."sensor_ID" AND e.date = s.date)
+                SELECT count(*) FROM updated""")
+            updated = cursor.fetchone()[0]
+            cursor.execute(f"DROP TABLE {staging}")
+        finally:
+            cursor.close()
+
+    print(f"Re-corrected {updated} of {tracked.shape[0]} extrapolated row(s) with real atm pressure, {ahead.shape[0]} re-extrapolated")
+    return corrected
+
+
+def update_extrapolated_depths(engine, rows):
+    """Update the atm pressure and depth of rows that are still extrapolated, leaving them unprocessed and tracked
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        rows (pd.DataFrame): `place`, `sensor_ID`, `date` and the new `atm_pressure`
+    """
+    if rows.shape[0] == 0:
+        return
+
+    columns = ["place", "sensor_ID", "date", "atm_pressure"]
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        try:
+            staging = copy_to_staging(cursor, "sensor_water_depth", columns, rows.loc[:, columns].itertuples(index = False, name = None))
+            cursor.execute(f"""
+                UPDATE sensor_water_depth w SET atm_pressure = s.atm_pressure,
+                    sensor_water_depth = (((w.sensor_pressure - s.atm_pressure) * 100) / (1020 * 9.81)) * 3.28084
+                FROM {staging} s
+                WHERE w.place = s.place AND w."sensor_ID" = s."sensor_ID" AND w.date = s.date""")
+            cursor.execute(f"DROP TABLE {staging}")
+        finally:
+            cursor.close()
+
+
+def write_results(engine, formatted_data, checkpoint_data = None, track_extrapolated = False):
+    """Upsert water depths and flag the raw data as processed in one transaction, so neither is written without the other
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        formatted_data (pd.DataFrame): Output of `format_interpolated_data`. Its `processed` column is removed
+        checkpoint_data (pd.DataFrame, optional): Raw rows read this run. If given, the sensors' checkpoints are updated too
+        track_extrapolated (bool): Add the rows written with extrapolated atm pressure to `atm_extrapolated_rows`
+    """
+    # Only rows that got a water depth without extrapolated atm pressure are flagged as processed
+    has_depth = formatted_data["sensor_water_depth"].notna().to_numpy()
+    flagged = has_depth & formatted_data["processed"].to_numpy(dtype = bool)
+    processed_keys = formatted_data.index[flagged].to_frame(index = False).assign(processed = True)
+
+    tracked_keys = None
+    if track_extrapolated:
+        tracked_keys = (formatted_data.loc[has_depth & ~flagged, ["atm_data_src", "atm_station_id"]]
+                        .reset_index().dropna(subset = ["atm_data_src", "atm_station_id"]))
+
+    # Drop the processed flag (without copying the other columns) so that sensor_water_depth is not marked as processed
+    del formatted_data["processed"]
+
+    with engine.begin() as conn:
+        write_table(formatted_data, "sensor_water_depth", conn)
+        print("Processed data to produce water depth!")
         
-        matched_measurements = pd.concat([matched_measurements, merged_measurements_and_surveys]).drop_duplicates()
-        matched_measurements["notes"] = matched_measurements["notes_x"]
-        matched_measurements.drop(columns = ['notes_x','notes_y'],inplace=True)
-        print("matched_measurements.shape: ", matched_measurements.shape)
+        updated = mark_sensor_data_processed(conn, processed_keys)
+        print(f"Updated {updated} raw data row(s) to indicate that they were processed!")
+
+        if tracked_keys is not None:
+            track_extrapolated_rows(conn, tracked_keys)
         
-    return matched_measurements
+        if checkpoint_data is not None:
+            update_checkpoints(conn, compute_checkpoints(checkpoint_data, processed_keys, tracked_keys))
 
 
-def format_interpolated_data(x):
-    print(inspect.stack()[0][3])    # print the name of the function we just entered
+def write_checkpoints(engine, checkpoint_data):
+    """Update the checkpoints of sensors that had no rows flagged as processed
 
-    formatted_data = x.copy()
-    formatted_data.rename(columns = {"pressure_mb":'atm_pressure', 'pressure':'sensor_pressure'}, inplace = True)
-    formatted_data["sensor_water_depth"] = ((((formatted_data["sensor_pressure"] - formatted_data["atm_pressure"]) * 100) / (1020 * 9.81)) * 3.28084)
-    formatted_data["qa_qc_flag"] = False; formatted_data["tag"] = "new_data"
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        checkpoint_data (pd.DataFrame): Raw rows read this run
+    """
+    with engine.begin() as conn:
+        update_checkpoints(conn, compute_checkpoints(checkpoint_data, checkpoint_data.loc[[], ["place", "sensor_ID", "date"]]))
+
+
+def process_batch(engine, new_data, surveys, atm_store = None, health = None, use_checkpoints = True, track_extrapolated = False):
+    """Match, interpolate, format and write one batch of raw data
+
+    Each stage's input is released as soon as the next stage has its output, so a batch
+    holds little more than one copy of its rows at a time.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        new_data (pd.DataFrame): Raw rows of whole places, from `read_new_sensor_data`
+        surveys (pd.DataFrame): Rows from `sensor_surveys`
+        atm_store (AtmPressureStore, optional): Atmospheric pressure store
+        health (StationHealth, optional): Station health records
+        use_checkpoints (bool): Update the sensors' checkpoints along with the results
+        track_extrapolated (bool): Track rows written with extrapolated atm pressure for `recorrect_extrapolated_rows`
+
+    Returns:
+        str: A message if the batch had nothing to write, otherwise None
+    """
+    prepared_data = match_measurements_to_survey(measurements = new_data, surveys = surveys)
+    #print(prepared_data.to_string())    # FOR DEBUGGING
     
-    col_list = ["place","sensor_ID","date","atm_pressure","sensor_pressure","voltage","notes","sensor_water_depth","qa_qc_flag", "tag","atm_data_src","atm_station_id", "processed"]
+    try: 
+        interpolated_data = interpolate_atm_data(prepared_data, store = atm_store, health = health, extrapolation = ATM_EXTRAPOLATION)
+    except Exception as ex:
+        interpolated_data = pd.DataFrame()
+        warnings.warn("Error interpolating atmospheric pressure data.")
+        template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+        message = template.format(type(ex).__name__, ex.args)
+        print(message)
+    del prepared_data
     
-    formatted_data = formatted_data.loc[:,col_list]
+    if interpolated_data.shape[0] == 0:
+        warnings.warn("No data to write to database!")
+
+        return "No data to write to database!"
     
-    formatted_data.set_index(['place', 'sensor_ID', 'date'], inplace=True)
+    formatted_data = format_interpolated_data(interpolated_data)
+    del interpolated_data
+    if capture is not None:
+        capture.save_frame("sensor_water_depth", formatted_data)
     
-    return formatted_data.drop_duplicates()
+    try:
+        write_results(engine, formatted_data, checkpoint_data = new_data if use_checkpoints else None,
+                      track_extrapolated = track_extrapolated)
+    except Exception as ex:
+        warnings.warn("Error adding processed data to `sensor_water_depth` and updating raw data with `processed` tag")
+        template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+        message = template.format(type(ex).__name__, ex.args)
+        print(message)
+
+
+def process_batch_pipelined(engine, new_data, surveys, atm_store = None, health = None, use_checkpoints = True, track_extrapolated = False):
+    """Like `process_batch`, but interpolates, formats and writes places as their atm data arrives
+
+    `resolve_atm_sources` hands places over as soon as their source is chosen, so the first places
+    are interpolated and formatted while slower stations are still being requested. Formatted
+    places are written on one writer thread: whatever piled up while the previous write ran goes
+    out as the next one, in its own transaction with the checkpoints of its sensors. The last
+    write also carries the checkpoints of the places that got no water depth, so their rows stay
+    pending as they would in `process_batch`.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        new_data (pd.DataFrame): Raw rows of whole places, from `read_new_sensor_data`
+        surveys (pd.DataFrame): Rows from `sensor_surveys`
+        atm_store (AtmPressureStore, optional): Atmospheric pressure store
+        health (StationHealth, optional): Station health records
+        use_checkpoints (bool): Update the sensors' checkpoints along with the results
+        track_extrapolated (bool): Track rows written with extrapolated atm pressure for `recorrect_extrapolated_rows`
+
+    Returns:
+        str: A message if the batch had nothing to write, otherwise None
+    """
+    prepared_data = match_measurements_to_survey(measurements = new_data, surveys = surveys)
+    place_names = list(prepared_data["place"].unique())
+    place_positions = prepared_data.groupby("place", observed = True, sort = False).indices
+    sensor_times = epoch_ns(prepared_data["date"])
+
+    writer = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "write")
+    writes = []
+    waiting = []    # formatted places not handed to the writer yet
+    checkpointed = set()    # places whose checkpoints went out with a write
+
+    def flush(last = False):
+        formatted_data = pd.concat(waiting) if len(waiting) > 1 else waiting[0]
+        waiting.clear()
+        if capture is not None:
+            capture.save_frame("sensor_water_depth", formatted_data)
+        checkpoint_data = None
+        if use_checkpoints:
+            # The last write takes every place left, written or not, like `process_batch` does with the whole batch
+            places = new_data["place"] if last else formatted_data.index.unique(level = "place")
+            checkpoint_data = new_data.loc[new_data["place"].isin(places) & ~new_data["place"].isin(checkpointed)]
+            checkpointed.update(checkpoint_data["place"].unique())
+        writes.append(writer.submit(write_results, engine, formatted_data, checkpoint_data = checkpoint_data,
+                                    track_extrapolated = track_extrapolated))
+
+    try:
+        try:
+            for place_atm_data, decided in resolve_atm_sources(prepared_data, store = atm_store, health = health):
+                ready = [p for p in place_names if p in decided]
+                with metrics.span("interpolate") as record:
+                    interpolated_data = interpolate_places(prepared_data, ready, place_atm_data, decided, place_positions = place_positions,
+                                                           sensor_times = sensor_times, extrapolation = ATM_EXTRAPOLATION)
+                    record["rows"] = interpolated_data.shape[0]
+                if interpolated_data.shape[0] == 0:
+                    continue
+
+                waiting.append(format_interpolated_data(interpolated_data))
+                del interpolated_data
+                if len(writes) == 0 or writes[-1].done():
+                    flush()
+        except Exception as ex:
+            warnings.warn("Error interpolating atmospheric pressure data.")
+            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            print(message)
+
+        if len(waiting) > 0:
+            flush(last = True)
+        elif use_checkpoints and len(writes) > 0:
+            # Nothing left to write, but the places that got no water depth still need their checkpoints
+            checkpoint_data = new_data.loc[~new_data["place"].isin(checkpointed)]
+            if checkpoint_data.shape[0] > 0:
+                writes.append(writer.submit(write_checkpoints, engine, checkpoint_data))
+    finally:
+        writer.shutdown(wait = True)
+
+    for write in writes:
+        if write.exception() is not None:
+            warnings.warn("Error adding processed data to `sensor_water_depth` and updating raw data with `processed` tag")
+            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+            message = template.format(type(write.exception()).__name__, write.exception().args)
+            print(message)
+
+    if len(writes) == 0:
+        warnings.warn("No data to write to database!")
+
+        return "No data to write to database!"
+
+
+def read_surveys(engine):
+    """All of `sensor_surveys`, sorted by place and survey date"""
+    with metrics.span("read", table = "sensor_surveys") as record:
+        surveys = pd.read_sql_table("sensor_surveys", engine).sort_values(['place','date_surveyed']).drop_duplicates()
+        record["rows"] = surveys.shape[0]
+    return surveys
 
 
-def main():
+@exports_metrics
+def main(atm_store = None, health = None, places = None):
+    """Process all new raw data once
+
+    Args:
+        atm_store (AtmPressureStore, optional): Atmospheric pressure store to use. Defaults to `get_atm_store`
+        health (StationHealth, optional): Station health records to use. Defaults to `get_station_health`
+        places (list, optional): Only process these places (see `main_sharded`). Defaults to all of them
+    """
     print("Entering main of process_pressure.py")
     
     # from env_vars import set_env_vars
@@ -549,22 +2819,55 @@ def main():
     # Establish DB engine  #
     ########################
 
-    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
-        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
-
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    engine = get_engine()
+    start_capture(places = places, sql_engine = SQL_ENGINE, hedge_delay = ATM_HEDGE_DELAY, memory_budget_mb = MEMORY_BUDGET_MB,
+                  extrapolation = ATM_EXTRAPOLATION)
+    if atm_store is None:
+        atm_store = get_atm_store(engine)
+    if health is None:
+        health = get_station_health(engine)
     
     #####################
     # Collect new data  #
     #####################
 
-    today= pd.to_datetime(datetime.utcnow())
-    start_date = today - timedelta(days=14)
+    start_date = datetime.now(dt_timezone.utc) - timedelta(days=14)
+    use_checkpoints = ensure_checkpoint_table(engine)
+
+    if places is not None:
+        metrics.count("shard_places_total", len(places))
+
+    if SQL_ENGINE == "fiman":
+        try:
+            process_fiman_in_database(engine, start_date, use_checkpoints = use_checkpoints, places = places)
+        except Exception as ex:
+            warnings.warn("In-database processing of FIMAN places failed; processing them in pandas instead")
+            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            print(message)
+
+    # Rows written with extrapolated atm pressure by earlier runs only need the atm data that was missing
+    track_extrapolated = ensure_recorrection_table(engine)
+    if track_extrapolated:
+        try:
+            recorrect_extrapolated_rows(engine, start_date, store = atm_store, health = health, places = places,
+                                        extrapolation = ATM_EXTRAPOLATION)
+        except Exception as ex:
+            warnings.warn("Re-correction of extrapolated rows failed; they will be retried next run")
+            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            print(message)
+
+    # The surveys don't depend on the raw data, so a pipelined run reads them at the same time
+    surveys_read = None
+    if PIPELINE:
+        reader = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "read")
+        surveys_read = reader.submit(read_surveys, engine)
+        reader.shutdown(wait = False)
 
     try:
-        query = f"SELECT * FROM sensor_data WHERE processed = 'FALSE' AND pressure > 800 and date >= '{start_date}'"
-        print(query)
-        new_data = pd.read_sql_query(query, engine).sort_values(['place','date']).drop_duplicates()
+        new_data = read_new_sensor_data(engine, start_date, use_checkpoints = use_checkpoints, skip_tracked = track_extrapolated,
+                                        places = places)
     except Exception as ex:
         new_data = pd.DataFrame()
         warnings.warn("Connection to database failed to return data")
@@ -577,11 +2880,13 @@ def main():
         return
     
     print(new_data.shape[0] , "new records!")
+    if capture is not None:
+        capture.save_frame("sensor_data", new_data)
         
     sensors_w_new_data = list(new_data["sensor_ID"].unique())
     
     try:
-        surveys = pd.read_sql_table("sensor_surveys", engine).sort_values(['place','date_surveyed']).drop_duplicates()
+        surveys = surveys_read.result() if surveys_read is not None else read_surveys(engine)
     except Exception as ex:
         surveys = pd.DataFrame()
         warnings.warn("Connection to database failed to return data")
@@ -592,57 +2897,722 @@ def main():
     if surveys.shape[0] == 0:
         warnings.warn("- No survey data!")
         return
+    if capture is not None:
+        capture.save_frame("sensor_surveys", surveys)
         
-    prepared_data = match_measurements_to_survey(measurements = new_data, surveys = surveys)
-    #print(prepared_data.to_string())    # FOR DEBUGGING
-    
-    try: 
-        interpolated_data = interpolate_atm_data(prepared_data)
-    except Exception as ex:
-        interpolated_data = pd.DataFrame()
-        warnings.warn("Error interpolating atmospheric pressure data.")
-        template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-        message = template.format(type(ex).__name__, ex.args)
-        print(message)
-    
-    if interpolated_data.shape[0] == 0:
-        warnings.warn("No data to write to database!")
+    # Large backlogs are processed a batch of places at a time to stay within the memory budget
+    batches = batch_places(new_data)
+    if len(batches) > 1:
+        print(f"Processing {new_data.shape[0]} records in {len(batches)} batches to stay within {MEMORY_BUDGET_MB:.0f} MB")
+
+    process = process_batch_pipelined if PIPELINE else process_batch
+    results = []
+    for places in batches:
+        batch = new_data.loc[new_data["place"].isin(places)] if len(batches) > 1 else new_data
+        results.append(process(engine, batch, surveys, atm_store = atm_store, health = health,
+                               use_checkpoints = use_checkpoints, track_extrapolated = track_extrapolated))
+
+    if all(result is not None for result in results):
+        return results[0]
+
+
+def serve(interval, shard = False):
+    """Run `main` every `interval` seconds in one long-lived process
+
+    The database pool, HTTP sessions, station health and an in-memory atm pressure store stay
+    warm between cycles. A tick that comes while the previous cycle is still running is skipped.
+    SIGTERM/SIGINT stop the loop after the running cycle finishes.
+
+    Args:
+        interval (float): Seconds between the starts of two cycles
+        shard (bool): Only process this worker's share of the places (see `PlaceLeases`)
+    """
+    print(f"Serving: processing new data every {interval} seconds")
+
+    atm_store = MemoryAtmPressureStore(backing = get_atm_store(get_engine()))
+    health = get_station_health(get_engine())
+    leases = None
+    if shard:
+        leases = PlaceLeases(get_engine())
+        leases.join()
+    cycle_lock = threading.Lock()
+    stop = threading.Event()
+
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+    def run_cycle():
+        try:
+            if leases is not None:
+                main_sharded(leases, atm_store = atm_store, health = health)
+            else:
+                main(atm_store = atm_store, health = health)
+        except Exception as ex:
+            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            print(message)
+        finally:
+            cycle_lock.release()
+
+    next_tick = time.monotonic()
+    while not stop.is_set():
+        if cycle_lock.acquire(blocking = False):
+            threading.Thread(target = run_cycle, name = "cycle", daemon = True).start()
+        else:
+            warnings.warn("Previous cycle is still running; skipping this tick")
+
+        next_tick += interval
+        stop.wait(max(0, next_tick - time.monotonic()))
+
+    # Let a running cycle finish its writes before exiting
+    with cycle_lock:
+        if leases is not None:
+            leases.leave()
+        get_engine().dispose()
+
+
+########################
+# Sharding             #
+########################
+
+# Advisory lock namespaces (the first key of the two-key form) of worker slots and of places
+SHARD_WORKER_LOCKS = 0x5DF0
+SHARD_PLACE_LOCKS = 0x5DF1
+
+# Most workers that can run side by side
+SHARD_MAX_WORKERS = int(os.environ.get("SDFP_SHARD_MAX_WORKERS", 64))
+
+
+class PlaceLeases:
+    """Ownership of places among workers started with `--shard`, through Postgres advisory locks
+
+    Each worker holds the lock of a worker slot on a connection of its own for as long as it runs,
+    so the live workers can be read from `pg_locks`. Places are assigned to live workers by
+    rendezvous hashing, so a worker joining or leaving only moves the places that hash to it.
+    Before processing a place its owner also takes the place's lock for the cycle, so no place is
+    processed by two workers even while they briefly disagree on who is alive. When a worker dies
+    its connection closes, its locks are released, and the other workers take over its places on
+    their next cycle.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        max_workers (int): Number of worker slots
+    """
+    def __init__(self, engine, max_workers = SHARD_MAX_WORKERS):
+        self.engine = engine
+        self.max_workers = max_workers
+        self.conn = None
+        self.slot = None
+
+    def join(self):
+        """Take the first free worker slot
+
+        Returns:
+            int: The slot
+        """
+        # Autocommit, so the connection doesn't sit idle in a transaction between cycles
+        self.conn = self.engine.connect().execution_options(isolation_level = "AUTOCOMMIT")
+        for slot in range(self.max_workers):
+            if self.conn.execute(text("SELECT pg_try_advisory_lock(:cls, :slot)"), {"cls": SHARD_WORKER_LOCKS, "slot": slot}).scalar():
+                self.slot = slot
+                print(f"Joined as worker {slot}")
+                return slot
+
+        self.conn.close()
+        self.conn = None
+        raise RuntimeError(f"All {self.max_workers} worker slots are taken (SDFP_SHARD_MAX_WORKERS)")
+
+    def workers(self):
+        """Slots of the live workers"""
+        rows = self.conn.execute(text("""SELECT objid::int FROM pg_locks
+                                         WHERE locktype = 'advisory' AND granted AND objsubid = 2 AND classid = :cls
+                                         AND database = (SELECT oid FROM pg_database WHERE datname = current_database())"""),
+                                 {"cls": SHARD_WORKER_LOCKS}).fetchall()
+        return sorted(r[0] for r in rows)
+
+    @staticmethod
+    def owner(place, workers):
+        """The worker a place belongs to: the one with the highest hash of (place, worker)"""
+        return max(workers, key = lambda w: hashlib.blake2b(f"{place}:{w}".encode(), digest_size = 8).digest())
+
+    def claim(self, places):
+        """Lock the places among `places` that belong to this worker
+
+        Places still locked by another worker (one that owned them before the workers changed)
+        are skipped this cycle. The lock connection is re-established if it was lost.
+
+        Returns:
+            list: The places locked. Pass them to `release` after the cycle
+        """
+        try:
+            workers = self.workers()
+        except Exception as ex:
+            warnings.warn("Lost the worker lock connection; joining again")
+            print(f"PlaceLeases.claim error: {type(ex).__name__}: {ex}")
+            self.leave()
+            self.join()
+            workers = self.workers()
+
+        if self.slot not in workers:
+            self.leave()
+            self.join()
+            workers = self.workers()
+
+        owned = [p for p in places if self.owner(p, workers) == self.slot]
+        if len(owned) == 0:
+            return []
+
+        rows = self.conn.execute(text("SELECT p FROM unnest(CAST(:places AS text[])) p WHERE pg_try_advisory_lock(:cls, hashtext(p))"),
+                                 {"places": owned, "cls": SHARD_PLACE_LOCKS}).fetchall()
+        claimed = [r[0] for r in rows]
+
+        print(f"Worker {self.slot} of {len(workers)}: {len(claimed)} of {len(places)} place(s)"
+              + (f", {len(owned) - len(claimed)} still locked by another worker" if len(claimed) < len(owned) else ""))
+        return claimed
+
+    def release(self, places):
+        """Unlock places locked by `claim`"""
+        if len(places) > 0 and self.conn is not None:
+            self.conn.execute(text("SELECT pg_advisory_unlock(:cls, hashtext(p)) FROM unnest(CAST(:places AS text[])) p"),
+                              {"places": list(places), "cls": SHARD_PLACE_LOCKS})
+
+    def leave(self):
+        """Give up the worker slot and any place locks"""
+        if self.conn is None:
+            return
+        try:
+            # The connection goes back to the pool, which would keep session-level locks held
+            self.conn.execute(text("SELECT pg_advisory_unlock_all()"))
+            self.conn.close()
+        except Exception:
+            self.conn.invalidate()
+        self.conn = None
+        self.slot = None
+
+
+def main_sharded(leases, atm_store = None, health = None):
+    """Run `main` on the places of this worker only
+
+    Args:
+        leases (PlaceLeases): This worker's leases, joined
+        atm_store (AtmPressureStore, optional): Passed on to `main`
+        health (StationHealth, optional): Passed on to `main`
+    """
+    with get_engine().connect() as conn:
+        places = [r[0] for r in conn.execute(text("SELECT DISTINCT place FROM sensor_surveys WHERE place IS NOT NULL"))]
+
+    claimed = leases.claim(places)
+    if len(claimed) == 0:
+        print("No places to process on this worker")
+        return
 
-        return "No data to write to database!"
-    
-    formatted_data = format_interpolated_data(interpolated_data)
-    # Copy data and drop processed flag so that sensor_water_depth is not marked as processed
-    copy = formatted_data.copy().drop(columns="processed")
-    
-    # Upsert the new data to the database table
-    try:
-        copy.to_sql("sensor_water_depth", engine, if_exists = "append", method=postgres_upsert)
-        print("Processed data to produce water depth!")
-    except Exception as ex:
-        warnings.warn("Error adding processed data to `sensor_water_depth`")
-        template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-        message = template.format(type(ex).__name__, ex.args)
-        print(message)
-    
-    updated_raw_data = new_data.merge(formatted_data.reset_index().loc[:,["place","sensor_ID","date","sensor_water_depth","processed"]], on=["place","sensor_ID","date"], how = "left")
-    # Drop duplicated 'processed' column and rename correct one to remove suffix 
-    updated_raw_data = updated_raw_data[updated_raw_data["sensor_water_depth"].notna()].drop(columns=["sensor_water_depth", "processed_x"])
-    updated_raw_data = updated_raw_data.rename(columns={"processed_y": "processed"})
-    # updated_raw_data["processed"] = True
-    
-    updated_raw_data.set_index(['place', 'sensor_ID', 'date'], inplace=True)
-    
-    # Update raw data to indicate it has been processed
     try:
-        updated_raw_data.to_sql("sensor_data", engine, if_exists = "append", method=postgres_upsert)
-        print("Updated raw data to indicate that it was processed!")
-    except Exception as ex:
-        warnings.warn("Error updating raw data with `processed` tag")
-        template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-        message = template.format(type(ex).__name__, ex.args)
-        print(message)
-    
-    engine.dispose()
+        return main(atm_store = atm_store, health = health, places = claimed)
+    finally:
+        leases.release(claimed)
+
+
+########################
+# Backfill             #
+########################
+
+def backfill_jobs(engine, begin, end, places = None, sensors = None, window = timedelta(days = 30)):
+    """Split a reprocessing request into (place, window) jobs
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        begin (pd.Timestamp): Start of the range to reprocess, UTC
+        end (pd.Timestamp): End of the range to reprocess, UTC
+        places (list, optional): Only these places
+        sensors (list, optional): Only these sensors
+        window (timedelta): Length of each job's time window
+
+    Returns:
+        list: Job dicts with `place`, `sensors`, `begin`, `end` and a stable `id`
+    """
+    query = "SELECT DISTINCT place FROM sensor_data WHERE date >= :begin AND date < :end"
+    params = {"begin": begin.to_pydatetime(), "end": end.to_pydatetime()}
+    if places:
+        query += " AND place = ANY(:places)"
+        params["places"] = list(places)
+    if sensors:
+        query += ' AND "sensor_ID" = ANY(:sensors)'
+        params["sensors"] = list(sensors)
+
+    with engine.connect() as conn:
+        found_places = sorted(r[0] for r in conn.execute(text(query), params))
+
+    jobs = []
+    for place in found_places:
+        window_begin = begin
+        while window_begin < end:
+            window_end = min(window_begin + window, end)
+            jobs.append({"id": f"{place}|{window_begin.isoformat()}|{window_end.isoformat()}",
+                         "place": place, "sensors": list(sensors) if sensors else None,
+                         "begin": window_begin, "end": window_end})
+            window_begin = window_end
+    return jobs
+
+
+def run_backfill_job(job):
+    """Reprocess one (place, window) job and write it through the normal upsert path
+
+    All raw rows in the window are read, whether or not they were processed before.
+    Sensor checkpoints are left alone.
+
+    Returns:
+        int: Number of rows written to `sensor_water_depth`
+
+    Raises:
+        RuntimeError: If rows that have a survey and an atm station got no water depth, e.g. because
+            their atm pressure couldn't be retrieved. What could be written is, and the job is retried
+    """
+    engine = get_engine()
+
+    query = (f"SELECT {', '.join(quote_ident(c) for c in SENSOR_DATA_COLUMNS)} FROM sensor_data "
+             "WHERE place = :place AND pressure > 800 AND date >= :begin AND date < :end")
+    params = {"place": job["place"], "begin": job["begin"].to_pydatetime(), "end": job["end"].to_pydatetime()}
+    if job["sensors"]:
+        query += ' AND "sensor_ID" = ANY(:sensors)'
+        params["sensors"] = job["sensors"]
+
+    new_data = read_compact(text(query), engine, params)
+    if new_data.shape[0] == 0:
+        return 0
+
+    surveys = pd.read_sql_query(text("SELECT * FROM sensor_surveys WHERE place = :place"), engine,
+                                params = {"place": job["place"]}).sort_values(['place','date_surveyed']).drop_duplicates()
+    if surveys.shape[0] == 0:
+        warnings.warn(f"- No survey data for {job['place']}!")
+        return 0
+
+    prepared_data = match_measurements_to_survey(measurements = new_data, surveys = surveys)
+    # Rows without a survey, or before a sensor's first one, can't be processed and don't hold the job back
+    processable = int(prepared_data["atm_station_id"].notna().sum())
+
+    interpolated_data = interpolate_atm_data(prepared_data, store = get_atm_store(engine), extrapolation = ATM_EXTRAPOLATION)
+    written = 0
+    if interpolated_data.shape[0] > 0:
+        formatted_data = format_interpolated_data(interpolated_data)
+        write_results(engine, formatted_data)
+        written = formatted_data.shape[0]
+
+    if written < processable:
+        raise RuntimeError(f"{processable - written} of {processable} row(s) got no atmospheric pressure")
+    return written
+
+
+def reset_process_state():
+    """Drop state inherited from the parent process that can't be shared (pooled DB connections)"""
+    global shared_engine
+    shared_engine = None
+
+
+def backfill(begin, end, places = None, sensors = None, workers = None, progress_path = "backfill_progress.json"):
+    """Reprocess a date range, spreading (place, 30-day window) jobs over a process pool
+
+    Finished jobs are recorded in `progress_path`, so an interrupted backfill picks up where
+    it stopped when run again with the same arguments. Each process applies `PROVIDER_LIMITS`
+    on its own, so keep `workers` modest.
+
+    Args:
+        begin (str): Start of the range, anything `pd.to_datetime` understands. UTC
+        end (str): End of the range (exclusive). UTC
+        places (list, optional): Only these places
+        sensors (list, optional): Only these sensors
+        workers (int, optional): Number of processes. Defaults to the number of CPUs, at most 4
+        progress_path (str): JSON file of finished job ids
+    """
+    begin = pd.to_datetime(begin, utc = True)
+    end = pd.to_datetime(end, utc = True)
+    workers = workers or min(4, os.cpu_count() or 1)
+
+    progress = {"done": []}
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+    done = set(progress["done"])
+
+    jobs = [job for job in backfill_jobs(get_engine(), begin, end, places = places, sensors = sensors) if job["id"] not in done]
+    print(f"Backfill {begin} to {end}: {len(jobs)} job(s) to run, {len(done)} already done, {workers} worker(s)")
+
+    # Workers open their own connections
+    get_engine().dispose()
+
+    failed = []
+    with ProcessPoolExecutor(max_workers = workers, initializer = reset_process_state) as pool:
+        futures = {pool.submit(run_backfill_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                rows = future.result()
+            except Exception as ex:
+                failed.append(job["id"])
+                print(f"Backfill job {job['id']} failed: {type(ex).__name__}: {ex}")
+                continue
+
+            progress["done"].append(job["id"])
+            with open(progress_path, "w") as f:
+                json.dump(progress, f)
+            print(f"Backfill job {job['id']} done: {rows} row(s) written ({len(progress['done'])} done)")
+
+    if len(failed) > 0:
+        warnings.warn(f"{len(failed)} backfill job(s) failed and will be retried on the next run: {', '.join(failed)}")
+
+
+########################
+# Record and replay    #
+########################
+
+# Each run saves its inputs, atm pressure, provider responses and output under `<dir>/<run_id>/`,
+# for `replay`. Empty disables it
+CAPTURE_DIR = os.environ.get("SDFP_CAPTURE_DIR", "")
+
+# The `RunCapture` of the running `main`, if any
+capture = None
+
+
+def capture_safe(func):
+    """Warn instead of failing the run when part of a capture can't be saved"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as ex:
+            warnings.warn(f"Capture failed in {func.__name__}; the snapshot is incomplete")
+            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            print(message)
+    return wrapper
+
+
+class RunCapture:
+    """Snapshot of one run, written as the run goes, for offline profiling with `replay`
+
+    Layout of the snapshot directory:
+        run.json                    run ID, start time, settings and library versions
+        sensor_data.NNN.parquet     raw rows read by the run
+        sensor_surveys.NNN.parquet  surveys read by the run
+        atm/NNNNN.parquet           each atm pressure window the run retrieved, listed in `atm.jsonl`
+        atm_sources.NNN.parquet     the source each place used (see `resolve_atm_sources`)
+        atm_used.NNN.parquet        each place's window of that source's data
+        responses/NNNNN.body        each provider response body, listed in `responses.jsonl`
+        sensor_water_depth.NNN.parquet  formatted output, one part per batch
+
+    Thread-safe; atm windows and responses are recorded from the fetch threads.
+    """
+
+    def __init__(self, directory, run_id):
+        self.path = os.path.join(directory, run_id)
+        os.makedirs(os.path.join(self.path, "atm"), exist_ok = True)
+        os.makedirs(os.path.join(self.path, "responses"), exist_ok = True)
+        self.lock = threading.Lock()
+        self.sequence = {}
+
+    def next(self, name):
+        """Next sequence number of `name`"""
+        with self.lock:
+            n = self.sequence.get(name, 0)
+            self.sequence[name] = n + 1
+        return n
+
+    def append(self, name, record):
+        """Append a JSON line to `name`"""
+        line = json.dumps(record, default = str)
+        with self.lock:
+            with open(os.path.join(self.path, name), "a") as f:
+                f.write(line + "\n")
+
+    @capture_safe
+    def save_run(self, **settings):
+        """Write `run.json`"""
+        info = {"run_id": metrics.run_id, "started": metrics.started, "pandas": pd.__version__, "numpy": np.__version__,
+                "pyarrow": pyarrow.__version__, **settings}
+        with open(os.path.join(self.path, "run.json"), "w") as f:
+            json.dump(info, f, default = str, indent = 2)
+
+    @capture_safe
+    def save_frame(self, name, df):
+        """Write the next part of frame `name`"""
+        df.to_parquet(os.path.join(self.path, f"{name}.{self.next(name):03d}.parquet"))
+
+    @capture_safe
+    def save_atm(self, atm_id, atm_src, begin_date, end_date, atm_data):
+        """Record the result of one atm pressure request (see `get_atm_pressure`)"""
+        n = self.next("atm")
+        record = {"call": n, "atm_id": str(atm_id), "atm_src": str(atm_src).upper(),
+                  "begin_date": str(begin_date), "end_date": str(end_date)}
+        if isinstance(atm_data, pd.DataFrame):
+            atm_data.to_parquet(os.path.join(self.path, "atm", f"{n:05d}.parquet"))
+            record["rows"] = atm_data.shape[0]
+        else:
+            record["error"] = str(atm_data)
+        self.append("atm.jsonl", record)
+
+    @capture_safe
+    def save_sources(self, place_atm_data, sources):
+        """Record the atm source places were given and their window of its data (see `resolve_atm_sources`)"""
+        self.save_frame("atm_sources", pd.DataFrame([{"place": p, "role": role, "atm_src": str(atm_src), "atm_id": str(atm_id)}
+                                                     for p, (role, atm_src, atm_id) in sources.items()]))
+        # One part per source, since providers return different columns and dtypes
+        frames = {}
+        for p, atm_data in place_atm_data.items():
+            if not atm_data.empty:
+                frames.setdefault(str(sources[p][1]).upper(), []).append(atm_data.assign(place = p))
+        for atm_src in sorted(frames):
+            self.save_frame("atm_used", pd.concat(frames[atm_src], ignore_index = True))
+
+    @capture_safe
+    def save_response(self, provider, url, params, r, attempt, stream = False):
+        """Record a provider response (see `provider_get`)
+
+        A streamed body is read here and put back as an in-memory stream, so the caller can still
+        read `r.raw` as if it came off the wire.
+        """
+        body = r.content
+        if stream:
+            r.raw = urllib3.response.HTTPResponse(body = io.BytesIO(body), headers = {}, status = r.status_code,
+                                                  preload_content = False)
+        n = self.next("responses")
+        with open(os.path.join(self.path, "responses", f"{n:05d}.body"), "wb") as f:
+            f.write(body)
+        self.append("responses.jsonl", {"response": n, "provider": provider, "url": url, "params": params,
+                                        "attempt": attempt + 1, "status": r.status_code,
+                                        "seconds": r.elapsed.total_seconds(), "bytes": len(body)})
+
+
+def start_capture(**settings):
+    """Capture the current run to `SDFP_CAPTURE_DIR`, if set
+
+    Returns:
+        RunCapture: The capture, or None if capture is disabled or pyarrow isn't installed
+    """
+    global capture
+    capture = None
+    if not CAPTURE_DIR:
+        return None
+    if pa_csv is None:
+        warnings.warn("SDFP_CAPTURE_DIR is set but pyarrow isn't installed; not capturing this run")
+        return None
+
+    capture = RunCapture(CAPTURE_DIR, metrics.run_id)
+    capture.save_run(**settings)
+    print(f"Capturing this run to {capture.path}")
+    return capture
+
+
+def load_frame(snapshot, name):
+    """All parts of frame `name` in a snapshot, concatenated
+
+    Returns:
+        pd.DataFrame: The frame, empty if the snapshot has none
+    """
+    parts = sorted(f for f in os.listdir(snapshot) if f.startswith(name + ".") and f.endswith(".parquet"))
+    frames = [pd.read_parquet(os.path.join(snapshot, f)) for f in parts]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+
+    # `concat_compact` renumbers the rows; keep a named index (the output's keys) as columns meanwhile
+    index = [name for name in frames[0].index.names if name is not None]
+    if len(index) > 0:
+        return concat_compact([frame.reset_index() for frame in frames]).set_index(index)
+    return concat_compact(frames)
+
+
+class ReplayAtmStore:
+    """Serves `get_atm_pressure` from the atm pressure a captured run retrieved
+
+    Stands in for `AtmPressureStore` during `replay`, for every source, so nothing is requested
+    from the providers or `api_data`. Requests are matched on their exact arguments; a request
+    the run didn't make warns and returns no data.
+    """
+
+    sources = {"NOAA", "NWS", "ISU", "FIMAN"}
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.calls = {}
+        path = os.path.join(snapshot, "atm.jsonl")
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    key = (record["atm_src"], record["atm_id"], record["begin_date"], record["end_date"])
+                    self.calls.setdefault(key, record)
+
+    def get_atm_pressure(self, atm_id, atm_src, begin_date, end_date):
+        record = self.calls.get((str(atm_src).upper(), str(atm_id), str(begin_date), str(end_date)))
+        if record is None:
+            warnings.warn(f"Snapshot has no atm pressure for {atm_src} station {atm_id} from {begin_date} to {end_date}")
+            return pd.DataFrame()
+        if "error" in record:
+            return record["error"]
+        return pd.read_parquet(os.path.join(self.snapshot, "atm", f"{record['call']:05d}.parquet"))
+
+
+@contextmanager
+def profiled(stage, profile = None, directory = "."):
+    """Profile a block with cProfile or tracemalloc
+
+    Args:
+        stage (str): Stage name, for the report and the `<stage>.prof` file
+        profile (str, optional): "cprofile" writes `<directory>/<stage>.prof` and prints the top
+            functions by cumulative time; "tracemalloc" prints the peak and the top allocating lines.
+            None only runs the block
+        directory (str): Where to write `.prof` files
+    """
+    match profile:
+        case "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                path = os.path.join(directory, f"{stage}.prof")
+                profiler.dump_stats(path)
+                print(f"{stage}: cProfile stats saved to {path}")
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+        case "tracemalloc":
+            tracemalloc.start()
+            try:
+                yield
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+                tracemalloc.stop()
+                print(f"{stage}: peak {peak / 2**20:.1f} MB, {current / 2**20:.1f} MB still allocated")
+                for stat in top:
+                    print(f"  {stat}")
+        case _:
+            yield
+
+
+def compare_output(replayed, captured):
+    """Compare replayed output to the output of the captured run
+
+    Returns:
+        bool: True if the rows, and all their values, are the same
+    """
+    if captured.shape[0] == 0:
+        print("Snapshot has no output to compare with")
+        return False
+
+    columns = [c for c in captured.columns if c in replayed.columns]
+    missing = captured.index.difference(replayed.index)
+    extra = replayed.index.difference(captured.index)
+    common = captured.index.intersection(replayed.index)
+    a = captured.loc[common, columns].sort_index()
+    b = replayed.loc[common, columns].sort_index()
+
+    differing = []
+    for column in columns:
+        if pd.api.types.is_numeric_dtype(a[column]) and not pd.api.types.is_bool_dtype(a[column]):
+            diff = (a[column].astype(float) - b[column].astype(float)).abs()
+            same = (diff == 0) | (a[column].isna() & b[column].isna())
+            if not same.all():
+                differing.append(f"{column} (max difference {diff.max():.3g})")
+        elif not (a[column].astype(object).eq(b[column].astype(object)) | (a[column].isna() & b[column].isna())).all():
+            differing.append(column)
+
+    print(f"Replayed {replayed.shape[0]} rows, captured {captured.shape[0]}: {len(missing)} missing, {len(extra)} extra")
+    if differing:
+        print(f"Values differ in {', '.join(differing)}")
+    identical = len(missing) == 0 and len(extra) == 0 and len(differing) == 0
+    print("Output is identical to the captured run" if identical else "Output differs from the captured run")
+    return identical
+
+
+def replay(snapshot, profile = None):
+    """Rerun a captured run's match, interpolate and format stages, without network or database access
+
+    Each place is interpolated from the atm source and data the captured run chose for it, so
+    replays are deterministic whatever order the run's requests came back in. Snapshots without
+    recorded sources go through `interpolate_atm_data`, served by `ReplayAtmStore`. All raw rows
+    are processed in one batch, and the output is compared with what the captured run wrote.
+
+    Args:
+        snapshot (str): Snapshot directory, `<SDFP_CAPTURE_DIR>/<run_id>`
+        profile (str, optional): Per-stage profiler, "cprofile" or "tracemalloc" (see `profiled`)
+
+    Returns:
+        pd.DataFrame: The formatted output
+    """
+    metrics.reset()
+    new_data = load_frame(snapshot, "sensor_data")
+    surveys = load_frame(snapshot, "sensor_surveys")
+    if new_data.shape[0] == 0 or surveys.shape[0] == 0:
+        warnings.warn(f"{snapshot} has no raw data or surveys to replay")
+        return pd.DataFrame()
+    print(f"Replaying {new_data.shape[0]} records from {snapshot}")
+    store = ReplayAtmStore(snapshot)
+
+    with profiled("match", profile, snapshot):
+        prepared_data = match_measurements_to_survey(measurements = new_data, surveys = surveys)
+    # Extrapolate the way the captured run did
+    extrapolation = ATM_EXTRAPOLATION
+    if os.path.exists(os.path.join(snapshot, "run.json")):
+        with open(os.path.join(snapshot, "run.json")) as f:
+            extrapolation = json.load(f).get("extrapolation", extrapolation)
+
+    chosen = load_frame(snapshot, "atm_sources")
+    with profiled("interpolate", profile, snapshot):
+        if chosen.shape[0] > 0:
+            atm_sources = {row.place: (row.role, row.atm_src, row.atm_id) for row in chosen.itertuples()}
+            used = load_frame(snapshot, "atm_used")
+            place_atm_data = {p: atm_data.drop(columns = "place").reset_index(drop = True)
+                              for p, atm_data in used.groupby("place", observed = True)} if used.shape[0] > 0 else {}
+            place_names = [p for p in prepared_data["place"].unique() if p in atm_sources]
+            with metrics.span("interpolate"):
+                interpolated_data = interpolate_places(prepared_data, place_names, place_atm_data, atm_sources, extrapolation = extrapolation)
+        else:
+            interpolated_data = interpolate_atm_data(prepared_data, store = store, extrapolation = extrapolation)
+    del prepared_data
+    with profiled("format", profile, snapshot):
+        formatted_data = format_interpolated_data(interpolated_data)
+    del interpolated_data
+
+    for record in metrics.spans:
+        if record["stage"] in ("match", "interpolate", "format"):
+            print(f"  {record['stage']}: {record['seconds']:.3f} s")
+    compare_output(formatted_data, load_frame(snapshot, "sensor_water_depth"))
+    return formatted_data
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description = "Process raw pressure measurements from sensors into water depth")
+    parser.add_argument("--serve", action = "store_true", help = "keep running and process new data every --interval seconds")
+    parser.add_argument("--interval", type = float, default = float(os.environ.get("SDFP_INTERVAL", 300)), help = "seconds between cycles in --serve mode (default: 300)")
+    parser.add_argument("--shard", action = "store_true", help = "share the places with the other --shard workers on the same database")
+    parser.add_argument("--backfill", nargs = 2, metavar = ("BEGIN", "END"), help = "reprocess all raw data from BEGIN up to END (UTC)")
+    parser.add_argument("--places", help = "comma-separated places to backfill (default: all)")
+    parser.add_argument("--sensors", help = "comma-separated sensor IDs to backfill (default: all)")
+    parser.add_argument("--workers", type = int, help = "backfill processes (default: number of CPUs, at most 4)")
+    parser.add_argument("--progress", default = "backfill_progress.json", help = "backfill progress file, for resuming")
+    parser.add_argument("--replay", metavar = "SNAPSHOT", help = "rerun a run captured with SDFP_CAPTURE_DIR, offline")
+    parser.add_argument("--profile", choices = ["cprofile", "tracemalloc"], help = "profile each --replay stage")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(args.replay, profile = args.profile)
+    elif args.backfill:
+        backfill(args.backfill[0], args.backfill[1],
+                 places = args.places.split(",") if args.places else None,
+                 sensors = args.sensors.split(",") if args.sensors else None,
+                 workers = args.workers,
+                 progress_path = args.progress)
+    elif args.serve:
+        serve(args.interval, shard = args.shard)
+    elif args.shard:
+        leases = PlaceLeases(get_engine())
+        leases.join()
+        try:
+            main_sharded(leases)
+        finally:
+            leases.leave()
+            get_engine().dispose()
+    else:
+        main()
+        get_engine().dispose()